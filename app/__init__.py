@@ -1,61 +1,53 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import asyncio
 import logging
+from contextlib import asynccontextmanager
 
 from app.api.database import task_db
 from app.api.routes import router
-from app.config.settings import DEBUG
+from app.config.settings import (
+    DEBUG, CORS_ALLOW_ORIGINS, NUM_WORKERS, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX, POLL_JITTER,
+    LEASE_HEARTBEAT_INTERVAL, STALE_TIMEOUT, STALE_CHECK_INTERVAL
+)
 from app.services.queue_worker import QueueWorkerPool
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(
-    title="Document to Markdown Converter",
-    description="Service for converting various document formats to Markdown",
-    version="1.0.0"
-)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-app.include_router(router, prefix="/api/v1")
-
 # Глобальная переменная для пула воркеров
 worker_pool = None
 
-@app.on_event("startup")
-async def startup_event():
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     global worker_pool
     
     # Инициализация базы данных
     await task_db.init_db()
     
-    # Очищаем зависшие задачи от предыдущего запуска сервера
-    cleaned = await task_db.cleanup_stale_processing_tasks()
-    if cleaned > 0:
-        logger.info(f"🧹 Очищено {cleaned} зависших задач от предыдущего запуска")
-    
-    # ИСПРАВЛЕНО: Используем существующий метод release_stale_tasks
-    # Освобождаем задачи из PROCESSING обратно в QUEUED для повторной обработки
-    reset_count = await task_db.release_stale_tasks(0)  # 0 секунд = немедленное освобождение
+    # Возвращаем в очередь задачи, прерванные остановкой сервера.
+    # Выполняется до запуска воркеров, иначе воркер успел бы захватить задачу,
+    # которую этот UPDATE тут же вернул бы в очередь.
+    reset_count = await task_db.reset_processing_on_boot()
     if reset_count > 0:
         logger.info(f"🔄 Сброшено {reset_count} задач из PROCESSING в QUEUED")
     
     # Запускаем пул воркеров для обработки очереди
     worker_pool = QueueWorkerPool(
         db_manager=task_db,
-        num_workers=3,  # Количество воркеров
-        poll_interval=1.0,  # Интервал опроса очереди (секунды)
-        stale_timeout=300,  # Таймаут для зависших задач (5 минут)
-        stale_check_interval=60  # Интервал проверки зависших задач (1 минута)
+        num_workers=NUM_WORKERS,  # Количество воркеров
+        min_poll_interval=POLL_INTERVAL_MIN,  # Интервал опроса под нагрузкой (секунды)
+        max_poll_interval=POLL_INTERVAL_MAX,  # Предел интервала для пустой очереди (секунды)
+        poll_jitter=POLL_JITTER,  # Разброс интервала, чтобы воркеры не опрашивали БД синхронно
+        heartbeat_interval=LEASE_HEARTBEAT_INTERVAL,  # Интервал продления аренды задачи
+        stale_timeout=STALE_TIMEOUT,  # Таймаут аренды для зависших задач
+        stale_check_interval=STALE_CHECK_INTERVAL  # Интервал проверки зависших задач
     )
     
+    # Роуты будят воркеры через пул после создания задачи
+    app.state.worker_pool = worker_pool
+    
     # Запускаем воркеры с обработкой ошибок для продакшена
     try:
         await worker_pool.start()
@@ -65,17 +57,40 @@ async def startup_event():
         # В продакшене можно добавить fallback стратегию или уведомление
         raise
     
-@app.on_event("shutdown")
-async def shutdown_event():
-    global worker_pool
+    yield
     
-    if worker_pool:
-        logger.info("⏹️ Останавливаем пул воркеров...")
-        try:
-            await worker_pool.stop()
-            logger.info("✅ Пул воркеров остановлен")
-        except Exception as e:
-            logger.error(f"❌ Ошибка при остановке пула воркеров: {e}")
+    logger.info("⏹️ Останавливаем пул воркеров...")
+    try:
+        await worker_pool.stop()
+        logger.info("✅ Пул воркеров остановлен")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при остановке пула воркеров: {e}")
+    
+    # Закрываем общее соединение с БД после остановки воркеров
+    await task_db.close()
+
+
+app = FastAPI(
+    title="Document to Markdown Converter",
+    description="Service for converting various document formats to Markdown",
+    version="1.0.0",
+    lifespan=lifespan,
+    # Ответы без явного класса (upload, корневые эндпоинты) сериализуются через orjson
+    default_response_class=ORJSONResponse
+)
+
+# CORS нужен только браузерным клиентам: без CORS_ALLOW_ORIGINS middleware не подключается,
+# а запросы без заголовка Origin (health-пробы, сервисные клиенты) он и так пропускает сразу
+if CORS_ALLOW_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ALLOW_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+app.include_router(router, prefix="/api/v1")
 
 @app.get("/")
 async def root():
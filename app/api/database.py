@@ -1,127 +1,627 @@
 import aiosqlite
 import asyncio
-import json
 import logging
-from datetime import datetime, timedelta
+import platform
+import random
+import sqlite3
+import time
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import AsyncIterator, Dict, List, Optional, Any, Tuple
 from contextlib import asynccontextmanager
 
 from app.config.settings import DB_PATH
 
 logger = logging.getLogger(__name__)
 
+# 256MB memory-mapped I/O: чтения идут напрямую из отображенных страниц без копирования.
+# В WSL mmap для файлов на смонтированных дисках не работает, там оставляем 0 (выключено).
+MMAP_SIZE = 0 if 'microsoft' in platform.uname().release.lower() else 268435456
+
+# Очередь записи: одиночные create_task/update_task собираются в пачки,
+# и вся пачка фиксируется одним COMMIT (одним fsync)
+WRITE_BATCH_SIZE = 64  # Максимум операций в одной транзакции
+WRITE_BATCH_WAIT = 0.005  # Сколько ждать следующих операций перед фиксацией (секунды)
+
+# Размер кеша подготовленных выражений sqlite3 на соединение (по умолчанию 128):
+# повторный execute того же текста SQL не компилирует запрос заново
+STATEMENT_CACHE_SIZE = 256
+
+# Сколько соответствий "текст сообщения -> messages.id" держать в памяти
+MESSAGE_CACHE_SIZE = 1024
+
+# Часы, привязанные один раз: горячие методы не ищут атрибут time.time при каждом вызове
+_now = time.time
+
+# Колонки задачи в порядке SELECT: строки читаются кортежами и превращаются
+# в dict одним zip, без row_factory на каждую строку
+TASK_COLUMNS = (
+    'id', 'original_filename', 'status', 'created_at', 'updated_at',
+    'downloaded', 'result_path', 'message', 'progress', 's3_url',
+    'file_hash', 'worker_id', 'processing_started', 'claimed_at'
+)
+PENDING_TASK_COLUMNS = ('id', 'original_filename', 'status', 'created_at', 'progress', 'downloaded')
+
+# Текст сообщения хранится один раз в таблице messages, задача ссылается на него по message_id.
+# Коррелированный подзапрос вместо JOIN, потому что он допустим и в RETURNING
+_SQL_MESSAGE_TEXT = "(SELECT text FROM messages WHERE messages.id = tasks.message_id)"
+_TASK_COLUMNS_SQL = ', '.join(_SQL_MESSAGE_TEXT if column == 'message' else column for column in TASK_COLUMNS)
+
+# Значение message_id при записи: id из кеша либо поиск по тексту, который
+# INSERT OR IGNORE добавил в той же пачке записи (параметры: id, текст)
+_SQL_MESSAGE_ID_REF = "COALESCE(?, (SELECT id FROM messages WHERE text = ?))"
+
+# Неизменяемые запросы горячего пути: один и тот же объект строки при каждом вызове
+# попадает в кеш подготовленных выражений sqlite3 без повторного разбора SQL
+_SQL_INSERT_TASK = f"""
+    INSERT INTO tasks (
+        id, original_filename, status, created_at, updated_at,
+        message_id, progress, file_hash
+    ) VALUES (?, ?, ?, ?, ?, {_SQL_MESSAGE_ID_REF}, ?, ?)
+"""
+
+_SQL_SELECT_TASK = f"SELECT {_TASK_COLUMNS_SQL} FROM tasks WHERE id = ?"
+
+_SQL_SELECT_TASK_STATUS = "SELECT status FROM tasks WHERE id = ?"
+
+_SQL_SELECT_RESULT_PATH = "SELECT result_path FROM tasks WHERE id = ?"
+
+_SQL_SELECT_TASK_BY_HASH = f"""
+    SELECT {_TASK_COLUMNS_SQL} FROM tasks
+    WHERE file_hash = ?
+    AND status = 'completed'
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+# Два варианта вместо "(? IS NULL OR created_at < ?)": так условие по курсору остаётся
+# диапазоном по idx_pending, и следующая страница не перебирает уже отданные строки.
+# Курсор - пара (created_at, id): created_at не уникален (create_tasks_bulk пишет
+# одно время на всю пачку), и по одному времени конец группы выпадал бы из выдачи
+_SQL_SELECT_PENDING = f"""
+    SELECT {', '.join(PENDING_TASK_COLUMNS)} FROM tasks
+    WHERE status != 'failed'
+    AND downloaded = 0
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+_SQL_SELECT_PENDING_BEFORE = f"""
+    SELECT {', '.join(PENDING_TASK_COLUMNS)} FROM tasks
+    WHERE status != 'failed'
+    AND downloaded = 0
+    AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+_SQL_COUNT_PENDING = "SELECT COUNT(*) FROM tasks WHERE status != 'failed' AND downloaded = 0"
+
+# Страница вместе с общим числом задач за один запрос. Некоррелированный подзапрос SQLite
+# вычисляет один раз; COUNT(*) OVER () здесь не подходит: он считал бы только строки
+# после курсора и заставил бы сортировать все подходящие строки до применения LIMIT
+_SQL_SELECT_PENDING_WITH_COUNT = f"""
+    SELECT {', '.join(PENDING_TASK_COLUMNS)}, ({_SQL_COUNT_PENDING}) FROM tasks
+    WHERE status != 'failed'
+    AND downloaded = 0
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+_SQL_SELECT_PENDING_BEFORE_WITH_COUNT = f"""
+    SELECT {', '.join(PENDING_TASK_COLUMNS)}, ({_SQL_COUNT_PENDING}) FROM tasks
+    WHERE status != 'failed'
+    AND downloaded = 0
+    AND (created_at, id) < (?, ?)
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?
+"""
+
+# Частые обновления статуса и результата идут готовыми запросами, минуя update_task
+_SQL_UPDATE_STATUS = "UPDATE tasks SET status = ?, updated_at = ? WHERE id = ?"
+_SQL_UPDATE_STATUS_MESSAGE = f"UPDATE tasks SET status = ?, message_id = {_SQL_MESSAGE_ID_REF}, updated_at = ? WHERE id = ?"
+_SQL_UPDATE_RESULT = "UPDATE tasks SET result_path = ?, progress = ?, updated_at = ? WHERE id = ?"
+_SQL_UPDATE_RESULT_S3 = "UPDATE tasks SET result_path = ?, progress = ?, s3_url = ?, updated_at = ? WHERE id = ?"
+
+_SQL_DELETE_TASK = "DELETE FROM tasks WHERE id = ?"
+
+_SQL_DELETE_OLD_TASKS_RETURNING = "DELETE FROM tasks WHERE created_at < ? RETURNING id, result_path"
+
+_SQL_SELECT_OLD_TASKS = "SELECT id, result_path FROM tasks WHERE created_at < ?"
+
+_SQL_DELETE_OLD_TASKS = "DELETE FROM tasks WHERE created_at < ?"
+
+_SQL_INSERT_MESSAGE = "INSERT OR IGNORE INTO messages (text) VALUES (?)"
+
+_SQL_SELECT_MESSAGE_ID = "SELECT id FROM messages WHERE text = ?"
+
+# Тексты, на которые не ссылается ни одна задача (ошибки уже удаленных задач)
+_SQL_DELETE_UNUSED_MESSAGES = """
+    DELETE FROM messages
+    WHERE id NOT IN (SELECT message_id FROM tasks WHERE message_id IS NOT NULL)
+"""
+
+_SQL_CLAIM_NEXT_TASK = f"""
+    UPDATE tasks
+    SET status = 'processing',
+        worker_id = ?,
+        processing_started = ?,
+        claimed_at = ?,
+        updated_at = ?
+    WHERE id = (
+        SELECT id FROM tasks
+        WHERE status = 'queued'
+        ORDER BY created_at ASC
+        LIMIT 1
+    )
+    RETURNING {_TASK_COLUMNS_SQL}
+"""
+
+# Тот же захват без RETURNING (SQLite < 3.35): строка потом читается по worker_id
+# и processing_started, которые уникальны для одного вызова
+_SQL_CLAIM_NEXT_TASK_LEGACY = """
+    UPDATE tasks
+    SET status = 'processing',
+        worker_id = ?,
+        processing_started = ?,
+        claimed_at = ?,
+        updated_at = ?
+    WHERE id = (
+        SELECT id FROM tasks
+        WHERE status = 'queued'
+        ORDER BY created_at ASC
+        LIMIT 1
+    )
+    AND status = 'queued'
+"""
+
+_SQL_SELECT_CLAIMED_TASK = f"""
+    SELECT {_TASK_COLUMNS_SQL} FROM tasks
+    WHERE worker_id = ? AND processing_started = ? AND status = 'processing'
+    ORDER BY created_at ASC
+"""
+
+# Захват пачки задач для диспетчера пула одной транзакцией
+_SQL_CLAIM_QUEUED_TASKS = f"""
+    UPDATE tasks
+    SET status = 'processing',
+        worker_id = ?,
+        processing_started = ?,
+        claimed_at = ?,
+        updated_at = ?
+    WHERE id IN (
+        SELECT id FROM tasks
+        WHERE status = 'queued'
+        ORDER BY created_at ASC
+        LIMIT ?
+    )
+    RETURNING {_TASK_COLUMNS_SQL}
+"""
+
+_SQL_CLAIM_QUEUED_TASKS_LEGACY = """
+    UPDATE tasks
+    SET status = 'processing',
+        worker_id = ?,
+        processing_started = ?,
+        claimed_at = ?,
+        updated_at = ?
+    WHERE id IN (
+        SELECT id FROM tasks
+        WHERE status = 'queued'
+        ORDER BY created_at ASC
+        LIMIT ?
+    )
+    AND status = 'queued'
+"""
+
+_SQL_REQUEUE_INTERRUPTED = """
+    UPDATE tasks
+    SET status = 'queued',
+        worker_id = NULL,
+        processing_started = NULL,
+        claimed_at = NULL,
+        message_id = (SELECT id FROM messages WHERE text = ?),
+        updated_at = ?
+    WHERE status = 'processing'
+"""
+
+_SQL_RENEW_LEASE = """
+    UPDATE tasks
+    SET claimed_at = ?
+    WHERE id = ? AND worker_id = ? AND status = 'processing'
+"""
+
+_SQL_RELEASE_STALE = """
+    UPDATE tasks
+    SET status = 'queued',
+        worker_id = NULL,
+        processing_started = NULL,
+        claimed_at = NULL,
+        message_id = (SELECT id FROM messages WHERE text = ?),
+        updated_at = ?
+    WHERE status = 'processing'
+    AND claimed_at < ?
+"""
+
+# Статистика очереди: количество по статусам ведут триггеры в task_counters,
+# остальное считается по частичным индексам, без прохода по всей таблице
+_SQL_STATUS_COUNTERS = "SELECT status, cnt FROM task_counters"
+
+_SQL_ACTIVE_WORKERS = """
+    SELECT COUNT(DISTINCT worker_id) AS active_workers
+    FROM tasks
+    WHERE status = 'processing'
+"""
+
+_SQL_COMPLETED_RECENT = """
+    SELECT COUNT(*) AS count, AVG(updated_at - processing_started) AS avg_processing_time
+    FROM tasks INDEXED BY idx_completed_duration
+    WHERE status = 'completed' AND updated_at > ?
+"""
+
+
+def _task_from_row(row: Optional[Tuple]) -> Optional[Dict[str, Any]]:
+    """Собирает dict задачи из кортежа, выбранного в порядке TASK_COLUMNS."""
+    return dict(zip(TASK_COLUMNS, row)) if row is not None else None
+
 
 class TaskDatabase:
-    def __init__(self, db_path: str = DB_PATH):
+    # Защита от SQL-инъекций через whitelist полей
+    ALLOWED_UPDATE_FIELDS = {'status', 'message_id', 'progress', 'result_path', 's3_url', 
+                             'downloaded', 'worker_id', 'processing_started', 'file_hash',
+                             'claimed_at'}
+    
+    def __init__(self, db_path: str = DB_PATH, read_pool_size: int = 4):
         self.db_path = db_path
-        self._init_lock = asyncio.Lock()  # Только для инициализации
+        self.read_pool_size = read_pool_size
+        self._write_lock = asyncio.Lock()  # Сериализует транзакции на общем соединении
+        self._conn: Optional[aiosqlite.Connection] = None  # Единственный писатель, открывается в init_db
+        self._readers: List[aiosqlite.Connection] = []  # Соединения только для чтения
+        self._read_pool: Optional[asyncio.Queue] = None  # Свободные читатели, выдаются по одному на запрос
+        self._write_queue: Optional[asyncio.Queue] = None  # (sql, params, future) для фоновой записи пачками
+        self._writer_task: Optional[asyncio.Task] = None
         self._supports_returning = False  # Будет проверено при инициализации
-        
-    @asynccontextmanager
-    async def get_connection(self):
-        """Главный метод для работы с БД."""
+        self._update_sql_cache: Dict[frozenset, Tuple[str, Tuple[str, ...]]] = {}  # SQL для update_task по набору полей
+        self._message_ids: Dict[str, int] = {}  # Текст сообщения -> messages.id, не больше MESSAGE_CACHE_SIZE
+        self._message_generation = 0  # Растет при каждой очистке кеша сообщений
+        self._pruning_messages = False  # Идет удаление неиспользуемых сообщений
+    
+    async def _connect(self) -> aiosqlite.Connection:
+        """Открывает долгоживущее соединение и настраивает его один раз."""
+        # Автокоммит на уровне драйвера: транзакции открывает get_write_connection
+        # явным BEGIN IMMEDIATE, а не sqlite3 неявным отложенным BEGIN
         db = await aiosqlite.connect(
             self.db_path,
-            timeout=20.0
+            timeout=20.0,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE
         )
         
-        # Настройки один раз при подключении
         await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute("PRAGMA busy_timeout=10000")
+        await db.execute("PRAGMA busy_timeout=30000")  # Ожидание блокировок на стороне SQLite
         await db.execute("PRAGMA synchronous=NORMAL")
-        await db.execute("PRAGMA cache_size=10000")  # 40MB кеша для ускорения запросов
+        await db.execute("PRAGMA cache_size=-65536")  # 64MB кеша страниц для ускорения запросов
+        await db.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        await db.execute("PRAGMA temp_store=MEMORY")  # Сортировки и временные таблицы в памяти
+        # Автоматический checkpoint раз в 10000 страниц WAL вместо 1000: при всплесках записи
+        # коммиты реже упираются в перенос WAL в основной файл
+        await db.execute("PRAGMA wal_autocheckpoint=10000")
+        return db
+    
+    async def _connect_reader(self) -> aiosqlite.Connection:
+        """
+        Открывает соединение только для чтения.
+        
+        В WAL читатели работают со своим снимком и не ждут писателя, поэтому
+        SELECT-запросы не стоят в очереди за коммитами update_task.
+        mode=ro запрещает запись на уровне VFS, query_only - на уровне SQL;
+        в автокоммите каждый SELECT - своя короткая транзакция чтения, и
+        снимок WAL не удерживается между запросами.
+        """
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        db = await aiosqlite.connect(
+            uri,
+            uri=True,
+            timeout=20.0,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        
+        await db.execute("PRAGMA busy_timeout=30000")
+        await db.execute("PRAGMA cache_size=-65536")
+        await db.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA query_only=1")
+        return db
+    
+    @asynccontextmanager
+    async def get_write_connection(self):
+        """
+        Главный метод для пишущих операций.
+        
+        Отдает общее соединение писателя под блокировкой, чтобы транзакции
+        разных корутин не перемешивались. Весь блок - одна транзакция:
+        BEGIN IMMEDIATE сразу берет блокировку записи (без повышения
+        отложенной транзакции посреди работы), COMMIT при выходе,
+        ROLLBACK при исключении или отмене корутины.
+        """
+        if self._conn is None:
+            raise RuntimeError("Database is not initialized, call init_db() first")
+        
+        db = self._conn
+        async with self._write_lock:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+                await db.execute("COMMIT")
+            except BaseException:
+                if db.in_transaction:
+                    await db.execute("ROLLBACK")
+                raise
+    
+    @asynccontextmanager
+    async def get_read_connection(self):
+        """
+        Берет свободное соединение из пула читателей и возвращает его после запроса.
+        
+        Если все читатели заняты, корутина ждет освобождения одного из них.
+        """
+        if self._read_pool is None:
+            raise RuntimeError("Database is not initialized, call init_db() first")
         
+        db = await self._read_pool.get()
         try:
             yield db
-        except Exception:
-            await db.rollback()
-            raise
         finally:
-            await db.close()
+            self._read_pool.put_nowait(db)
+    
+    async def _enqueue_write(self, sql: str, params: Tuple, new_message: Optional[str] = None):
+        """
+        Ставит запрос в очередь записи и ждет фиксации его пачки.
+        
+        new_message - текст, которого нет в кеше сообщений: его INSERT OR IGNORE
+        ставится в очередь прямо перед запросом и фиксируется той же пачкой.
+        Исключение при выполнении запроса пробрасывается вызывающему.
+        """
+        if self._write_queue is None:
+            raise RuntimeError("Database is not initialized, call init_db() first")
+        
+        loop = asyncio.get_running_loop()
+        if new_message is not None:
+            message_future = loop.create_future()
+            self._write_queue.put_nowait((_SQL_INSERT_MESSAGE, (new_message,), message_future))
+        future = loop.create_future()
+        self._write_queue.put_nowait((sql, params, future))
+        
+        if new_message is not None:
+            await message_future
+        await future
+        
+        if new_message is not None:
+            await self._remember_message(new_message)
+    
+    async def _writer_loop(self):
+        """Фоновая запись: собирает операции из очереди в пачки и фиксирует их."""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        
+        while not stopping:
+            item = await self._write_queue.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            deadline = loop.time() + WRITE_BATCH_WAIT
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._write_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._write_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                
+                if item is None:
+                    # Остановка: дописываем уже собранное и выходим
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            await self._flush_writes(batch)
     
-    async def _with_retry(self, operation, max_retries=3):
-        """Простой retry для database locked."""
+    async def _flush_writes(self, batch: List[Tuple[str, Tuple, asyncio.Future]]):
+        """
+        Выполняет пачку операций одной транзакцией.
+        
+        Подряд идущие одинаковые запросы выполняются через executemany. Каждая
+        группа обернута в SAVEPOINT: при ошибке группа откатывается и
+        выполняется поштучно, чтобы ошибка досталась только своему вызывающему.
+        """
+        results: List[Optional[BaseException]] = [None] * len(batch)
+        
+        async def run(db, sql: str, indexes: List[int]):
+            await db.execute("SAVEPOINT write_batch")
+            try:
+                if len(indexes) == 1:
+                    await db.execute(sql, batch[indexes[0]][1])
+                else:
+                    await db.executemany(sql, [batch[i][1] for i in indexes])
+            except Exception as e:
+                await db.execute("ROLLBACK TO write_batch")
+                await db.execute("RELEASE write_batch")
+                if len(indexes) == 1:
+                    results[indexes[0]] = e
+                else:
+                    for i in indexes:
+                        await run(db, sql, [i])
+                return
+            await db.execute("RELEASE write_batch")
+        
+        try:
+            async with self.get_write_connection() as db:
+                start = 0
+                while start < len(batch):
+                    sql = batch[start][0]
+                    end = start + 1
+                    while end < len(batch) and batch[end][0] is sql:
+                        end += 1
+                    await run(db, sql, list(range(start, end)))
+                    start = end
+        except Exception as e:
+            # Транзакция не зафиксирована - ошибка у всех операций пачки
+            results = [e] * len(batch)
+        
+        for (_, _, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+    
+    async def close(self):
+        """Закрывает соединения с БД (вызывается при остановке сервиса)."""
+        # Дописываем накопленные операции до закрытия писателя
+        if self._writer_task is not None:
+            self._write_queue.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+            self._write_queue = None
+        
+        for reader in self._readers:
+            await reader.close()
+        self._readers = []
+        self._read_pool = None
+        
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+    
+    async def _with_retry(self, operation, max_retries=2):
+        """
+        Одна внешняя повторная попытка при SQLITE_BUSY/SQLITE_LOCKED.
+        
+        Обычное ожидание блокировок выполняет сам SQLite через busy_timeout,
+        сюда ошибка доходит, только если ожидание не помогло (например,
+        устаревший снимок в WAL). Ошибка распознается по коду SQLite, а не по
+        тексту сообщения; пауза перед повтором - full jitter: случайное значение
+        от 0 до 50 мс * 2^attempt, не больше секунды.
+        """
         for attempt in range(max_retries):
             try:
                 return await operation()
             except aiosqlite.OperationalError as e:
-                if "locked" in str(e).lower() and attempt < max_retries - 1:
-                    await asyncio.sleep(0.1 * (2 ** attempt))
+                # Расширенный код ошибки: младший байт - основной код SQLite
+                code = getattr(e, 'sqlite_errorcode', 0) & 0xFF
+                if code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) and attempt < max_retries - 1:
+                    await asyncio.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
                     continue
                 raise
-        
+    
     async def init_db(self):
-        async def _init():
-            async with self.get_connection() as db:
-                # Проверяем версию SQLite для поддержки RETURNING
-                cursor = await db.execute("SELECT sqlite_version()")
-                version_str = (await cursor.fetchone())[0]
-                version_tuple = tuple(map(int, version_str.split(".")))
-                self._supports_returning = version_tuple >= (3, 35, 0)
-                logger.info(f"SQLite version: {version_str}, RETURNING support: {self._supports_returning}")
-                
-                await db.execute('''
-                    CREATE TABLE IF NOT EXISTS tasks (
-                        id TEXT PRIMARY KEY,
-                        original_filename TEXT NOT NULL,
-                        status TEXT NOT NULL,
-                        created_at REAL NOT NULL,
-                        updated_at REAL NOT NULL,
-                        downloaded INTEGER DEFAULT 0,
-                        result_path TEXT,
-                        message TEXT,
-                        progress INTEGER DEFAULT 0,
-                        s3_url TEXT,
-                        file_hash TEXT,
-                        worker_id TEXT,
-                        processing_started REAL
-                    )
-                ''')
-                
-                # Create indexes
-                await db.execute('CREATE INDEX IF NOT EXISTS idx_status ON tasks(status)')
-                await db.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON tasks(created_at)')
-                await db.execute('CREATE INDEX IF NOT EXISTS idx_downloaded ON tasks(downloaded)')
-                await db.execute('CREATE INDEX IF NOT EXISTS idx_file_hash ON tasks(file_hash)')  # Для быстрого поиска по hash
-                
-                # Новый индекс для статистики очереди
-                await db.execute('''
-                    CREATE INDEX IF NOT EXISTS idx_completed_recent
-                    ON tasks(updated_at) WHERE status = 'completed'
-                ''')
-                
-                await db.commit()
-                
-                # Запускаем миграции после создания базовой схемы
-                await self.run_migrations()
-                
-                logger.info(f"Database initialized with WAL mode: {self.db_path}")
+        if self._conn is None:
+            self._conn = await self._connect()
         
-        async with self._init_lock:
-            await self._with_retry(_init)
+        async with self.get_write_connection() as db:
+            # Проверяем версию SQLite для поддержки RETURNING
+            cursor = await db.execute("SELECT sqlite_version() AS version")
+            version_str = (await cursor.fetchone())[0]
+            version_tuple = tuple(map(int, version_str.split(".")))
+            self._supports_returning = version_tuple >= (3, 35, 0)
+            logger.info("SQLite version: %s, RETURNING support: %s", version_str, self._supports_returning)
+            
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id TEXT PRIMARY KEY,
+                    original_filename TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    downloaded INTEGER DEFAULT 0,
+                    result_path TEXT,
+                    message_id INTEGER REFERENCES messages(id),
+                    progress INTEGER DEFAULT 0,
+                    s3_url TEXT,
+                    file_hash TEXT,
+                    worker_id TEXT,
+                    processing_started REAL,
+                    claimed_at REAL
+                )
+            ''')
+            
+            # Create indexes
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON tasks(created_at)')
+            
+            # Частичный индекс для get_pending_tasks: покрывает и фильтр, и сортировку,
+            # поэтому idx_downloaded (единственным потребителем был этот запрос) больше не нужен
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_pending
+                ON tasks(created_at DESC, id DESC) WHERE downloaded = 0 AND status != 'failed'
+            ''')
+            await db.execute('DROP INDEX IF EXISTS idx_downloaded')
+        
+        # Запускаем миграции после создания базовой схемы
+        await self.run_migrations()
+        
+        # Читатели открываются после писателя: файл БД и WAL уже созданы
+        if not self._readers:
+            self._readers = [await self._connect_reader() for _ in range(self.read_pool_size)]
+            self._read_pool = asyncio.Queue()
+            for reader in self._readers:
+                self._read_pool.put_nowait(reader)
+        
+        if self._writer_task is None:
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        
+        logger.info("Database initialized with WAL mode: %s", self.db_path)
     
     async def run_migrations(self):
         """Запускает миграции БД с версионированием через PRAGMA user_version."""
-        TARGET_SCHEMA_VERSION = 2
+        TARGET_SCHEMA_VERSION = 8
         
-        async with self.get_connection() as db:
+        async with self.get_write_connection() as db:
             # Получаем текущую версию схемы
             cursor = await db.execute("PRAGMA user_version")
             current_version = (await cursor.fetchone())[0]
             
-            logger.info(f"Current DB schema version: {current_version}, target: {TARGET_SCHEMA_VERSION}")
+            logger.info("Current DB schema version: %d, target: %d", current_version, TARGET_SCHEMA_VERSION)
             
             # Применяем миграции последовательно
             if current_version < 2:
                 await self._migrate_to_v2(db)
                 logger.info("Applied migration to v2")
             
+            if current_version < 3:
+                await self._migrate_to_v3(db)
+                logger.info("Applied migration to v3")
+            
+            if current_version < 4:
+                await self._migrate_to_v4(db)
+                logger.info("Applied migration to v4")
+            
+            if current_version < 5:
+                await self._migrate_to_v5(db)
+                logger.info("Applied migration to v5")
+            
+            if current_version < 6:
+                await self._migrate_to_v6(db)
+                logger.info("Applied migration to v6")
+            
+            if current_version < 7:
+                await self._migrate_to_v7(db)
+                logger.info("Applied migration to v7")
+            
+            if current_version < 8:
+                await self._migrate_to_v8(db)
+                logger.info("Applied migration to v8")
+            
             # Обновляем версию схемы
             if current_version < TARGET_SCHEMA_VERSION:
                 await db.execute(f"PRAGMA user_version = {TARGET_SCHEMA_VERSION}")
-                await db.commit()
-                logger.info(f"Updated schema version to {TARGET_SCHEMA_VERSION}")
+                logger.info("Updated schema version to %d", TARGET_SCHEMA_VERSION)
     
     async def _migrate_to_v2(self, db):
         """
@@ -176,174 +676,535 @@ class TaskDatabase:
         
         logger.info("Migration v2 completed: queue support added")
     
+    async def _migrate_to_v3(self, db):
+        """
+        Миграция v2 -> v3: аренда (lease) задач воркерами.
+        - Новая колонка: claimed_at - время последнего продления аренды
+        - Новый индекс для поиска задач с истекшей арендой
+        """
+        cursor = await db.execute("PRAGMA table_info(tasks)")
+        column_names = [col[1] for col in await cursor.fetchall()]
+        
+        if 'claimed_at' not in column_names:
+            await db.execute("ALTER TABLE tasks ADD COLUMN claimed_at REAL")
+            logger.info("Added claimed_at column")
+        
+        # Задачи, захваченные до миграции, считаем арендованными с момента начала обработки
+        await db.execute("""
+            UPDATE tasks
+            SET claimed_at = processing_started
+            WHERE status = 'processing' AND claimed_at IS NULL
+        """)
+        
+        # idx_claimed_at - для быстрого поиска задач с истекшей арендой
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_claimed_at
+            ON tasks(claimed_at)
+            WHERE status = 'processing'
+        """)
+        
+        logger.info("Migration v3 completed: task leases added")
+    
+    async def _migrate_to_v4(self, db):
+        """
+        Миграция v3 -> v4: частичные индексы для кеша по hash и статистики.
+        - idx_hash_completed обслуживает и фильтр, и сортировку get_task_by_hash,
+          idx_file_hash больше не используется
+        - idx_completed_duration включает processing_started, поэтому среднее время
+          обработки считается без чтения строк таблицы; заменяет idx_completed_recent
+        - idx_failed для счетчика упавших задач
+        """
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_hash_completed
+            ON tasks(file_hash, created_at DESC)
+            WHERE status = 'completed'
+        """)
+        await db.execute("DROP INDEX IF EXISTS idx_file_hash")
+        
+        # Индексы статистики ссылаются на processing_started (колонка v2),
+        # поэтому создаются здесь, а не в init_db
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_completed_duration
+            ON tasks(updated_at, processing_started)
+            WHERE status = 'completed'
+        """)
+        await db.execute("DROP INDEX IF EXISTS idx_completed_recent")
+        
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_failed
+            ON tasks(updated_at)
+            WHERE status = 'failed'
+        """)
+        
+        logger.info("Migration v4 completed: hash and statistics indexes added")
+    
+    async def _migrate_to_v5(self, db):
+        """
+        Миграция v4 -> v5: удаляет общий индекс idx_status.
+        
+        Почти все строки - completed/failed, а все запросы по статусу уже
+        обслуживаются частичными индексами (idx_queue, idx_stale_tasks,
+        idx_completed_duration, idx_failed, idx_pending); широкий индекс только
+        замедлял каждую вставку и смену статуса.
+        """
+        await db.execute("DROP INDEX IF EXISTS idx_status")
+        
+        logger.info("Migration v5 completed: idx_status dropped")
+    
+    async def _migrate_to_v6(self, db):
+        """
+        Миграция v5 -> v6: тексты сообщений выносятся в таблицу messages.
+        - Повторяющиеся сообщения ('Returned to queue after timeout' и т.п.)
+          хранятся один раз, в задаче остается только целочисленный message_id
+        - Старая колонка message обнуляется, а не удаляется: DROP COLUMN
+          появился только в SQLite 3.35
+        """
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL UNIQUE
+            )
+        """)
+        
+        cursor = await db.execute("PRAGMA table_info(tasks)")
+        column_names = [col[1] for col in await cursor.fetchall()]
+        
+        if 'message_id' not in column_names:
+            await db.execute("ALTER TABLE tasks ADD COLUMN message_id INTEGER REFERENCES messages(id)")
+            logger.info("Added message_id column")
+        
+        # Переносим тексты существующих задач (колонки message нет только в новой БД)
+        if 'message' in column_names:
+            await db.execute("""
+                INSERT OR IGNORE INTO messages (text)
+                SELECT DISTINCT message FROM tasks WHERE message IS NOT NULL
+            """)
+            await db.execute("""
+                UPDATE tasks
+                SET message_id = (SELECT id FROM messages WHERE text = tasks.message),
+                    message = NULL
+                WHERE message IS NOT NULL
+            """)
+        
+        logger.info("Migration v6 completed: messages interned")
+    
+    async def _migrate_to_v7(self, db):
+        """
+        Миграция v6 -> v7: счетчики задач по статусам в таблице task_counters.
+        - Триггеры на INSERT/DELETE/смену статуса поддерживают счетчики в той же
+          транзакции, и статистика очереди читает несколько строк вместо подсчета
+        - idx_failed был нужен только счетчику упавших задач и удаляется
+        """
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS task_counters (
+                status TEXT PRIMARY KEY,
+                cnt INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        
+        # Начальные значения считаем по текущим задачам; строка нужна для каждого
+        # статуса заранее, потому что триггеры только изменяют существующие счетчики
+        await db.execute("DELETE FROM task_counters")
+        await db.execute("""
+            INSERT INTO task_counters (status, cnt)
+            SELECT status, COUNT(*) FROM tasks GROUP BY status
+        """)
+        await db.execute("""
+            INSERT OR IGNORE INTO task_counters (status, cnt)
+            VALUES ('pending', 0), ('queued', 0), ('processing', 0), ('completed', 0), ('failed', 0)
+        """)
+        
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS task_cnt_ins AFTER INSERT ON tasks
+            BEGIN
+                UPDATE task_counters SET cnt = cnt + 1 WHERE status = NEW.status;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS task_cnt_del AFTER DELETE ON tasks
+            BEGIN
+                UPDATE task_counters SET cnt = cnt - 1 WHERE status = OLD.status;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS task_cnt_upd AFTER UPDATE OF status ON tasks
+            WHEN OLD.status != NEW.status
+            BEGIN
+                UPDATE task_counters SET cnt = cnt - 1 WHERE status = OLD.status;
+                UPDATE task_counters SET cnt = cnt + 1 WHERE status = NEW.status;
+            END
+        """)
+        
+        await db.execute("DROP INDEX IF EXISTS idx_failed")
+        
+        logger.info("Migration v7 completed: status counters added")
+    
+    async def _migrate_to_v8(self, db):
+        """
+        Миграция v7 -> v8: idx_pending включает id.
+        
+        Страницы неподтвержденных задач листаются курсором (created_at, id);
+        с id в индексе и фильтр по курсору, и сортировка идут по индексу.
+        """
+        await db.execute("DROP INDEX IF EXISTS idx_pending")
+        await db.execute("""
+            CREATE INDEX idx_pending
+            ON tasks(created_at DESC, id DESC) WHERE downloaded = 0 AND status != 'failed'
+        """)
+        
+        logger.info("Migration v8 completed: idx_pending extended with id")
+    
+    def _message_ref(self, text: Optional[str]) -> Tuple[Optional[int], Optional[str]]:
+        """
+        Параметры _SQL_MESSAGE_ID_REF для текста сообщения.
+        
+        Returns:
+            (id, None) для текста из кеша, (None, текст) для нового текста -
+            его нужно добавить INSERT OR IGNORE в той же транзакции
+        """
+        if text is None:
+            return None, None
+        message_id = self._message_ids.get(text)
+        if message_id is not None:
+            return message_id, None
+        return None, text
+    
+    async def _remember_message(self, text: str):
+        """Кеширует id уже зафиксированного текста, если кеш не сбрасывали во время поиска."""
+        generation = self._message_generation
+        row = await self._fetch_one(_SQL_SELECT_MESSAGE_ID, (text,))
+        # Во время очистки messages найденный id может быть тут же удален
+        if row is None or self._pruning_messages or generation != self._message_generation:
+            return
+        
+        # Вытесняется самая старая запись
+        if len(self._message_ids) >= MESSAGE_CACHE_SIZE:
+            del self._message_ids[next(iter(self._message_ids))]
+        self._message_ids[text] = row[0]
+    
+    def _forget_messages(self):
+        """Сбрасывает кеш сообщений; начатые до сброса поиски в него уже не попадут."""
+        self._message_ids.clear()
+        self._message_generation += 1
+    
+    async def _prune_messages(self):
+        """
+        Удаляет тексты сообщений, на которые больше не ссылается ни одна задача.
+        
+        Удаление идет через очередь записи: запросы с id из кеша, поставленные
+        раньше, фиксируются до него, а кеш сбрасывается до постановки в очередь
+        и после фиксации, так что удаленный id больше не выдается.
+        """
+        self._pruning_messages = True
+        self._forget_messages()
+        try:
+            await self._enqueue_write(_SQL_DELETE_UNUSED_MESSAGES, ())
+        finally:
+            self._forget_messages()
+            self._pruning_messages = False
+    
+    def _resolve_message(self, updates: Dict[str, Any], by_text: bool = False) -> Tuple[Dict[str, Any], Optional[str]]:
+        """
+        Заменяет текст 'message' в наборе изменений на message_id/message_text.
+        
+        Args:
+            updates: Изменения задачи
+            by_text: Не брать id из кеша (для записи мимо очереди, где
+                порядок относительно очистки messages не гарантирован)
+        
+        Returns:
+            (изменения, текст для INSERT OR IGNORE или None)
+        """
+        if 'message' not in updates:
+            return updates, None
+        updates = dict(updates)
+        text = updates.pop('message')
+        if by_text:
+            message_id, new_message = None, text
+        else:
+            message_id, new_message = self._message_ref(text)
+        updates['message_id'] = message_id
+        updates['message_text'] = new_message
+        return updates, new_message
+    
     async def create_task(self, task_id: str, task_data: Dict[str, Any]):
-        async def _create():
-            async with self.get_connection() as db:
-                await db.execute('''
-                    INSERT INTO tasks (
-                        id, original_filename, status, created_at, updated_at,
-                        message, progress, file_hash
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    task_id,
-                    task_data['original_filename'],
-                    task_data['status'],
-                    datetime.now().timestamp(),
-                    datetime.now().timestamp(),
-                    task_data.get('message', ''),
-                    task_data.get('progress', 0),
-                    task_data.get('file_hash', None)  # Сохраняем hash файла для кеширования
-                ))
-                await db.commit()
-        
-        await self._with_retry(_create)
+        now = _now()
+        message_id, new_message = self._message_ref(task_data.get('message', ''))
+        await self._enqueue_write(_SQL_INSERT_TASK, (
+            task_id,
+            task_data['original_filename'],
+            task_data['status'],
+            now,
+            now,
+            message_id,
+            new_message,
+            task_data.get('progress', 0),
+            task_data.get('file_hash', None)  # Сохраняем hash файла для кеширования
+        ), new_message)
+    
+    def _get_update_sql(self, updates: Dict[str, Any]) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Возвращает закешированный текст UPDATE для набора полей.
+        
+        Поля сортируются, поэтому одинаковый набор всегда дает одну и ту же
+        строку SQL и SQLite не разбирает запрос заново.
+        
+        Returns:
+            Кортеж (SQL, порядок колонок для значений)
+        """
+        key = frozenset(updates)
+        cached = self._update_sql_cache.get(key)
+        if cached is None:
+            fields = []
+            columns = []
+            for k in sorted(key):
+                if k == 'message_text':
+                    continue
+                if k == 'message_id':
+                    # Два значения: id из кеша и текст для поиска (см. _SQL_MESSAGE_ID_REF)
+                    fields.append(f"message_id = {_SQL_MESSAGE_ID_REF}")
+                    columns += ['message_id', 'message_text']
+                else:
+                    fields.append(f"{k} = ?")
+                    columns.append(k)
+            cached = (f"UPDATE tasks SET {', '.join(fields)} WHERE id = ?", tuple(columns))
+            self._update_sql_cache[key] = cached
+        return cached
     
     async def update_task(self, task_id: str, updates: Dict[str, Any]):
-        async def _update():
-            # Защита от SQL-инъекций через whitelist полей
-            ALLOWED_FIELDS = {'status', 'message', 'progress', 'result_path', 's3_url', 
-                            'downloaded', 'worker_id', 'processing_started', 'file_hash'}
-            
-            # Фильтруем только разрешенные поля (используем новую переменную!)
-            filtered_updates = {k: v for k, v in updates.items() if k in ALLOWED_FIELDS}
-            filtered_updates['updated_at'] = datetime.now().timestamp()
-            
-            fields = ', '.join(f"{k} = ?" for k in filtered_updates.keys())
-            values = list(filtered_updates.values()) + [task_id]
-            
-            async with self.get_connection() as db:
-                await db.execute(
-                    f"UPDATE tasks SET {fields} WHERE id = ?",
-                    values
-                )
-                await db.commit()
+        updates, new_message = self._resolve_message(updates)
+        # Фильтруем только разрешенные поля (используем новую переменную!)
+        filtered_updates = {k: v for k, v in updates.items() if k in self.ALLOWED_UPDATE_FIELDS}
+        if 'message_id' in filtered_updates:
+            filtered_updates['message_text'] = new_message
+        filtered_updates['updated_at'] = _now()
+        
+        sql, columns = self._get_update_sql(filtered_updates)
+        values = [filtered_updates[k] for k in columns] + [task_id]
         
-        await self._with_retry(_update)
+        await self._enqueue_write(sql, values, new_message)
+    
+    async def create_tasks_bulk(self, tasks: List[Tuple[str, Dict[str, Any]]]):
+        """
+        Создает несколько задач одной транзакцией через executemany.
+        
+        Args:
+            tasks: Список пар (task_id, task_data) в формате create_task
+        """
+        if not tasks:
+            return
+        
+        now = _now()
+        # Запись идет мимо очереди, поэтому message_id ищется только по тексту,
+        # а сами тексты добавляются в той же транзакции
+        rows = [
+            (
+                task_id,
+                task_data['original_filename'],
+                task_data['status'],
+                now,
+                now,
+                None,
+                task_data.get('message', ''),
+                task_data.get('progress', 0),
+                task_data.get('file_hash', None)
+            )
+            for task_id, task_data in tasks
+        ]
+        messages = {(row[6],) for row in rows}
+        
+        async with self.get_write_connection() as db:
+            await db.executemany(_SQL_INSERT_MESSAGE, messages)
+            await db.executemany(_SQL_INSERT_TASK, rows)
+    
+    async def update_tasks_bulk(self, task_ids: List[str], updates: Dict[str, Any]):
+        """
+        Применяет одинаковые изменения к нескольким задачам одной транзакцией.
+        
+        Args:
+            task_ids: Идентификаторы задач
+            updates: Поля для обновления (тот же whitelist, что и в update_task)
+        """
+        if not task_ids:
+            return
+        
+        updates, new_message = self._resolve_message(updates, by_text=True)
+        filtered_updates = {k: v for k, v in updates.items() if k in self.ALLOWED_UPDATE_FIELDS}
+        if 'message_id' in filtered_updates:
+            filtered_updates['message_text'] = new_message
+        filtered_updates['updated_at'] = _now()
+        
+        sql, columns = self._get_update_sql(filtered_updates)
+        values = [filtered_updates[k] for k in columns]
+        
+        async with self.get_write_connection() as db:
+            if new_message is not None:
+                await db.execute(_SQL_INSERT_MESSAGE, (new_message,))
+            await db.executemany(
+                sql,
+                [values + [task_id] for task_id in task_ids]
+            )
     
     async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
-        async with self.get_connection() as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM tasks WHERE id = ?", (task_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-                return None
+        async with self.get_read_connection() as db:
+            async with db.execute(_SQL_SELECT_TASK, (task_id,)) as cursor:
+                return _task_from_row(await cursor.fetchone())
+    
+    async def get_task_status(self, task_id: str) -> Optional[str]:
+        """Возвращает только статус задачи, без сборки полного dict."""
+        row = await self._fetch_one(_SQL_SELECT_TASK_STATUS, (task_id,))
+        return row[0] if row else None
+    
+    async def get_result_path(self, task_id: str) -> Optional[str]:
+        """Возвращает только путь к результату задачи."""
+        row = await self._fetch_one(_SQL_SELECT_RESULT_PATH, (task_id,))
+        return row[0] if row else None
     
     async def get_task_by_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
         """Найти успешно завершенную задачу по hash файла для кеширования."""
-        async with self.get_connection() as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                """SELECT * FROM tasks 
-                   WHERE file_hash = ? 
-                   AND status = 'completed'
-                   ORDER BY created_at DESC
-                   LIMIT 1""", 
-                (file_hash,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-                return None
-    
-    async def get_pending_tasks(self) -> List[Dict[str, Any]]:
-        async with self.get_connection() as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('''
-                SELECT * FROM tasks 
-                WHERE status != 'failed' 
-                AND downloaded = 0
-                ORDER BY created_at DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        async with self.get_read_connection() as db:
+            async with db.execute(_SQL_SELECT_TASK_BY_HASH, (file_hash,)) as cursor:
+                return _task_from_row(await cursor.fetchone())
+    
+    async def get_pending_tasks(
+        self, limit: int = 100, before_created_at: Optional[float] = None, before_id: str = ''
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Постранично отдает неподтвержденные задачи, от новых к старым.
+        Следующая страница запрашивается с before_created_at/before_id = created_at/id
+        последней задачи (без before_id - все задачи старше before_created_at);
+        в памяти держится не больше limit строк.
+        """
+        if before_created_at is None:
+            sql, params = _SQL_SELECT_PENDING, (limit,)
+        else:
+            sql, params = _SQL_SELECT_PENDING_BEFORE, (before_created_at, before_id, limit)
+        
+        # Страница забирается целиком, и соединение возвращается в пул до первого yield:
+        # иначе вызывающий, прервавший перебор, держал бы его до сборки генератора
+        async with self.get_read_connection() as db:
+            async with db.execute(sql, params) as cursor:
+                rows = await cursor.fetchmany(limit)
+        
+        for row in rows:
+            yield dict(zip(PENDING_TASK_COLUMNS, row))
+    
+    async def get_pending_tasks_with_count(
+        self, limit: int = 100, before_created_at: Optional[float] = None, before_id: str = ''
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Страница неподтвержденных задач (как get_pending_tasks) и общее их число.
+        Число приходит в каждой строке страницы, так что отдельный COUNT нужен
+        только если страница пуста.
+        """
+        if before_created_at is None:
+            sql, params = _SQL_SELECT_PENDING_WITH_COUNT, (limit,)
+        else:
+            sql, params = _SQL_SELECT_PENDING_BEFORE_WITH_COUNT, (before_created_at, before_id, limit)
+        
+        rows = await self._fetch_all(sql, params)
+        if not rows:
+            return [], await self.count_pending_tasks()
+        return [dict(zip(PENDING_TASK_COLUMNS, row)) for row in rows], rows[0][-1]
+    
+    async def count_pending_tasks(self) -> int:
+        row = await self._fetch_one(_SQL_COUNT_PENDING)
+        return row[0] if row else 0
     
     async def update_task_status(self, task_id: str, status: str, message: str = None):
-        updates = {'status': status}
         if message:
-            updates['message'] = message
-        await self.update_task(task_id, updates)
+            message_id, new_message = self._message_ref(message)
+            await self._enqueue_write(
+                _SQL_UPDATE_STATUS_MESSAGE, (status, message_id, new_message, _now(), task_id), new_message
+            )
+        else:
+            await self._enqueue_write(_SQL_UPDATE_STATUS, (status, _now(), task_id))
     
     async def update_task_result(self, task_id: str, result_path: str, progress: int, s3_url: str = None):
-        updates = {
-            'result_path': result_path,
-            'progress': progress
-        }
         if s3_url:
-            updates['s3_url'] = s3_url
-        await self.update_task(task_id, updates)
+            await self._enqueue_write(
+                _SQL_UPDATE_RESULT_S3, (result_path, progress, s3_url, _now(), task_id)
+            )
+        else:
+            await self._enqueue_write(_SQL_UPDATE_RESULT, (result_path, progress, _now(), task_id))
     
     async def delete_task(self, task_id: str):
         """Delete a single task from database."""
-        async def _delete():
-            async with self.get_connection() as db:
-                await db.execute(
-                    "DELETE FROM tasks WHERE id = ?",
-                    (task_id,)
+        async with self.get_write_connection() as db:
+            await db.execute(_SQL_DELETE_TASK, (task_id,))
+            logger.info("Deleted task %s from database", task_id)
+    
+    async def delete_tasks_bulk(self, task_ids: List[str]) -> int:
+        """
+        Удаляет несколько задач одной транзакцией.
+        
+        Идентификаторы передаются пачками по 500, чтобы не превысить
+        лимит параметров SQLite (SQLITE_MAX_VARIABLE_NUMBER).
+        
+        Returns:
+            Количество удаленных задач
+        """
+        if not task_ids:
+            return 0
+        
+        deleted = 0
+        async with self.get_write_connection() as db:
+            for start in range(0, len(task_ids), 500):
+                chunk = task_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                cursor = await db.execute(
+                    f"DELETE FROM tasks WHERE id IN ({placeholders})",
+                    chunk
                 )
-                await db.commit()
-                logger.info(f"Deleted task {task_id} from database")
+                deleted += cursor.rowcount
         
-        await self._with_retry(_delete)
+        logger.info("Deleted %d tasks from database", deleted)
+        return deleted
     
     async def cleanup_old_tasks(self, days: int = 7):
-        async def _cleanup():
-            cutoff_time = (datetime.now() - timedelta(days=days)).timestamp()
-            
-            async with self.get_connection() as db:
+        cutoff_time = _now() - days * 86400
+        
+        async with self.get_write_connection() as db:
+            if self._supports_returning:
+                # Удаляем и получаем строки для очистки файлов за один проход по индексу
+                async with db.execute(_SQL_DELETE_OLD_TASKS_RETURNING, (cutoff_time,)) as cursor:
+                    old_tasks = await cursor.fetchall()
+            else:
                 # Get old tasks for file cleanup
-                async with db.execute(
-                    "SELECT id, result_path FROM tasks WHERE created_at < ?",
-                    (cutoff_time,)
-                ) as cursor:
+                async with db.execute(_SQL_SELECT_OLD_TASKS, (cutoff_time,)) as cursor:
                     old_tasks = await cursor.fetchall()
                 
                 # Delete from DB
-                await db.execute(
-                    "DELETE FROM tasks WHERE created_at < ?",
-                    (cutoff_time,)
-                )
-                await db.commit()
-                
-                return old_tasks
+                await db.execute(_SQL_DELETE_OLD_TASKS, (cutoff_time,))
+        
+        # Тексты ошибок уникальны для задачи и без этого копились бы в messages
+        if old_tasks:
+            await self._prune_messages()
         
-        return await self._with_retry(_cleanup)
+        return [{'id': task_id, 'result_path': result_path} for task_id, result_path in old_tasks]
     
-    async def cleanup_stale_processing_tasks(self) -> int:
+    async def reset_processing_on_boot(self) -> int:
         """
-        Помечает все задачи в статусе PROCESSING как FAILED.
-        Вызывается при старте сервера для очистки зависших задач от предыдущего запуска.
+        Возвращает в очередь все задачи, прерванные остановкой сервера.
+        
+        Вызывается при старте до запуска воркеров: одним UPDATE переводит
+        PROCESSING в QUEUED и снимает аренду. Статус PENDING после миграции v2
+        не встречается, поэтому условие только по processing и идет по
+        частичному индексу idx_stale_tasks.
         
         Returns:
-            Количество очищенных задач
+            Количество возвращенных в очередь задач
         """
-        async def _cleanup_stale():
-            async with self.get_connection() as db:
-                server_start_time = datetime.now().timestamp()
-                
-                # Обновляем все задачи в PROCESSING и PENDING на FAILED
-                await db.execute("""
-                    UPDATE tasks 
-                    SET status = 'failed', 
-                        message = 'Server was restarted while processing',
-                        updated_at = ?
-                    WHERE status IN ('processing', 'pending')
-                """, (server_start_time,))
-                
-                # Получаем количество измененных строк
-                cursor = await db.execute("SELECT changes()")
-                row = await cursor.fetchone()
-                await db.commit()
-                
-                count = row[0] if row else 0
-                if count > 0:
-                    logger.info(f"Marked {count} stale processing/pending tasks as failed")
-                
-                return count
+        message = 'Returned to queue after server restart'
+        async with self.get_write_connection() as db:
+            await db.execute(_SQL_INSERT_MESSAGE, (message,))
+            cursor = await db.execute(_SQL_REQUEUE_INTERRUPTED, (message, _now()))
+            count = cursor.rowcount
         
-        return await self._with_retry(_cleanup_stale)
+        if count > 0:
+            logger.info("Returned %d interrupted tasks to queue", count)
+        
+        return count
     
     async def get_next_queued_task(self, worker_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -356,170 +1217,147 @@ class TaskDatabase:
             Словарь с ПОЛНЫМИ данными захваченной задачи или None если очередь пуста
         """
         async def _get_next():
-            async with self.get_connection() as db:
-                db.row_factory = aiosqlite.Row  # Важно для получения имен колонок
-                now = datetime.now().timestamp()
+            async with self.get_write_connection() as db:
+                now = _now()
                 
                 if self._supports_returning:
                     # Современный SQLite с RETURNING (3.35.0+)
-                    cursor = await db.execute("""
-                        UPDATE tasks
-                        SET status = 'processing',
-                            worker_id = ?,
-                            processing_started = ?,
-                            updated_at = ?
-                        WHERE id = (
-                            SELECT id FROM tasks
-                            WHERE status = 'queued'
-                            ORDER BY created_at ASC
-                            LIMIT 1
-                        )
-                        RETURNING *
-                    """, (worker_id, now, now))
-                    
-                    row = await cursor.fetchone()
-                    await db.commit()
+                    cursor = await db.execute(_SQL_CLAIM_NEXT_TASK, (worker_id, now, now, now))
                     
-                    if row:
-                        # Возвращаем полный словарь с данными задачи
-                        return dict(row)
-                    return None
+                    # Полный словарь с данными задачи или None
+                    return _task_from_row(await cursor.fetchone())
                 else:
-                    # Fallback для старых версий SQLite
-                    await db.execute("BEGIN IMMEDIATE")
-                    try:
-                        # Находим следующую задачу
-                        cursor = await db.execute("""
-                            SELECT id FROM tasks
-                            WHERE status = 'queued'
-                            ORDER BY created_at ASC
-                            LIMIT 1
-                        """)
-                        
-                        row = await cursor.fetchone()
-                        if not row:
-                            await db.rollback()
-                            return None
-                        
-                        task_id = row[0] if isinstance(row, tuple) else row['id']
-                        
-                        # Захватываем её
-                        await db.execute("""
-                            UPDATE tasks
-                            SET status = 'processing',
-                                worker_id = ?,
-                                processing_started = ?,
-                                updated_at = ?
-                            WHERE id = ? AND status = 'queued'
-                        """, (worker_id, now, now, task_id))
-                        
-                        # Проверяем, что обновили ровно 1 строку
-                        cursor = await db.execute("SELECT changes()")
-                        changes = (await cursor.fetchone())[0]
-                        
-                        if changes == 1:
-                            # Получаем ПОЛНЫЕ данные обновленной задачи
-                            cursor = await db.execute("""
-                                SELECT * FROM tasks WHERE id = ?
-                            """, (task_id,))
-                            row = await cursor.fetchone()
-                            await db.commit()
-                            
-                            if row:
-                                # Возвращаем полный словарь с данными задачи
-                                return dict(row)
-                            return None
-                        else:
-                            # Кто-то уже захватил эту задачу
-                            await db.rollback()
-                            return None
-                    except Exception:
-                        await db.rollback()
-                        raise
+                    # Fallback для старых версий SQLite: поиск и захват одним UPDATE
+                    cursor = await db.execute(_SQL_CLAIM_NEXT_TASK_LEGACY, (worker_id, now, now, now))
+                    
+                    if cursor.rowcount != 1:
+                        # Очередь пуста
+                        return None
+                    
+                    # Получаем ПОЛНЫЕ данные захваченной задачи
+                    cursor = await db.execute(_SQL_SELECT_CLAIMED_TASK, (worker_id, now))
+                    return _task_from_row(await cursor.fetchone())
         
         return await self._with_retry(_get_next)
     
-    async def release_stale_tasks(self, timeout_seconds: int = 300) -> int:
+    async def get_next_queued_tasks(self, worker_id: str, batch: int = 8) -> List[Dict[str, Any]]:
         """
-        Освобождает зависшие задачи, возвращая их в очередь.
+        Атомарно захватывает до batch задач из очереди одной транзакцией.
         
         Args:
-            timeout_seconds: Время в секундах после которого задача считается зависшей
+            worker_id: Идентификатор владельца аренды захваченных задач
+            batch: Максимальное количество задач
             
         Returns:
-            Количество освобожденных задач
+            Список задач в порядке постановки в очередь (пустой, если очередь пуста)
         """
-        async def _release():
-            async with self.get_connection() as db:
-                cutoff_time = datetime.now().timestamp() - timeout_seconds
-                
-                # Возвращаем зависшие задачи в очередь
-                await db.execute("""
-                    UPDATE tasks
-                    SET status = 'queued',
-                        worker_id = NULL,
-                        processing_started = NULL,
-                        message = 'Returned to queue after timeout',
-                        updated_at = ?
-                    WHERE status = 'processing'
-                    AND processing_started < ?
-                """, (datetime.now().timestamp(), cutoff_time))
-                
-                # Получаем количество освобожденных задач
-                cursor = await db.execute("SELECT changes()")
-                count = (await cursor.fetchone())[0]
-                await db.commit()
-                
-                if count > 0:
-                    logger.warning(f"Released {count} stale tasks back to queue")
+        async def _get_next():
+            async with self.get_write_connection() as db:
+                now = _now()
                 
-                return count
+                if self._supports_returning:
+                    cursor = await db.execute(_SQL_CLAIM_QUEUED_TASKS, (worker_id, now, now, now, batch))
+                    rows = await cursor.fetchall()
+                else:
+                    cursor = await db.execute(_SQL_CLAIM_QUEUED_TASKS_LEGACY, (worker_id, now, now, now, batch))
+                    if cursor.rowcount < 1:
+                        return []
+                    cursor = await db.execute(_SQL_SELECT_CLAIMED_TASK, (worker_id, now))
+                    rows = await cursor.fetchall()
+            
+            # RETURNING не гарантирует порядок строк
+            tasks = [_task_from_row(row) for row in rows]
+            tasks.sort(key=lambda task: task['created_at'])
+            return tasks
         
-        return await self._with_retry(_release)
+        return await self._with_retry(_get_next)
     
-    async def get_queue_statistics(self) -> Dict[str, Any]:
+    async def renew_task_lease(self, task_id: str, worker_id: str) -> bool:
         """
-        Получает статистику очереди одним оптимизированным запросом.
+        Продлевает аренду задачи (heartbeat воркера).
         
         Returns:
-            Словарь со статистикой
+            False если задача больше не принадлежит воркеру (аренда отозвана)
         """
-        async with self.get_connection() as db:
-            hour_ago = datetime.now().timestamp() - 3600
+        async with self.get_write_connection() as db:
+            now = _now()
+            cursor = await db.execute(_SQL_RENEW_LEASE, (now, task_id, worker_id))
+            return cursor.rowcount == 1
+    
+    async def release_stale_tasks(self, timeout_seconds: int = 300) -> int:
+        """
+        Освобождает задачи с истекшей арендой, возвращая их в очередь.
+        
+        Args:
+            timeout_seconds: Время в секундах без heartbeat, после которого задача считается зависшей
             
-            # Единый оптимизированный запрос для всей статистики
-            cursor = await db.execute("""
-                SELECT 
-                    SUM(CASE WHEN status = 'queued' THEN 1 ELSE 0 END) as queued,
-                    SUM(CASE WHEN status = 'processing' THEN 1 ELSE 0 END) as processing,
-                    SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed,
-                    SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed,
-                    COUNT(*) as total,
-                    COUNT(DISTINCT CASE WHEN status = 'processing' AND worker_id IS NOT NULL 
-                          THEN worker_id END) as active_workers,
-                    SUM(CASE WHEN status = 'completed' AND updated_at > ? THEN 1 ELSE 0 END) as completed_last_hour,
-                    AVG(CASE WHEN status = 'completed' AND processing_started IS NOT NULL 
-                        AND updated_at > ? 
-                        THEN updated_at - processing_started END) as avg_processing_time
-                FROM tasks
-            """, (hour_ago, hour_ago))
+        Returns:
+            Количество освобожденных задач
+        """
+        message = 'Returned to queue after timeout'
+        async with self.get_write_connection() as db:
+            now = _now()
+            cutoff_time = now - timeout_seconds
+            await db.execute(_SQL_INSERT_MESSAGE, (message,))
             
-            row = await cursor.fetchone()
+            # Возвращаем зависшие задачи в очередь
+            cursor = await db.execute(_SQL_RELEASE_STALE, (message, now, cutoff_time))
+            count = cursor.rowcount
             
-            # Формируем результат
-            stats = {
-                'queued': row[0] or 0,
-                'processing': row[1] or 0,
-                'completed': row[2] or 0,
-                'failed': row[3] or 0,
-                'total': row[4] or 0,
-                'active_workers': row[5] or 0,
-                'processing_rate': round((row[6] or 0) / 60, 2),  # задач в минуту
-                'avg_processing_time': round(row[7] or 0, 2)  # секунд на задачу
-            }
+            if count > 0:
+                logger.warning("Released %d stale tasks back to queue", count)
             
-            return stats
-
+            return count
+    
+    async def _fetch_one(self, sql: str, params: Tuple = ()) -> Optional[Tuple]:
+        """Выполняет запрос на свободном читателе и возвращает первую строку."""
+        async with self.get_read_connection() as db:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+    
+    async def _fetch_all(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        """Выполняет запрос на свободном читателе и возвращает все строки."""
+        async with self.get_read_connection() as db:
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+    
+    async def get_queue_statistics(self) -> Dict[str, Any]:
+        """
+        Получает статистику очереди.
+        
+        Количество задач по статусам читается из task_counters (их ведут триггеры),
+        остальные запросы выполняются параллельно на пуле читателей по частичным
+        индексам, поэтому стоимость не растет вместе с историей завершенных задач.
+        
+        Returns:
+            Словарь со статистикой
+        """
+        hour_ago = _now() - 3600
+        
+        counter_rows, workers, recent = await asyncio.gather(
+            self._fetch_all(_SQL_STATUS_COUNTERS),
+            self._fetch_one(_SQL_ACTIVE_WORKERS),
+            self._fetch_one(_SQL_COMPLETED_RECENT, (hour_ago,))
+        )
+        counters = dict(counter_rows)
+        queued = counters.get('queued', 0)
+        processing = counters.get('processing', 0)
+        completed = counters.get('completed', 0)
+        failed = counters.get('failed', 0)
+        
+        # Формируем результат
+        stats = {
+            'queued': queued,
+            'processing': processing,
+            'completed': completed,
+            'failed': failed,
+            'total': queued + processing + completed + failed,
+            'active_workers': workers[0],
+            'processing_rate': round(recent[0] / 60, 2),  # задач в минуту
+            'avg_processing_time': round(recent[1] or 0, 2)  # секунд на задачу
+        }
+        
+        return stats
 
 # Global instance
 task_db = TaskDatabase()
\ No newline at end of file
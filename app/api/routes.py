@@ -1,35 +1,36 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, PlainTextResponse
-from typing import Optional
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Request, Query
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
+from typing import Optional, Tuple
+from functools import lru_cache
 import uuid
 import os
 import asyncio
 import logging
-from pathlib import Path
 from datetime import datetime
 import zipfile
 import tempfile
-import shutil
-from concurrent.futures import ThreadPoolExecutor
-import asyncio
 import hashlib
 import aiofiles
-import io
-from fastapi.responses import JSONResponse
+from urllib.parse import quote, unquote
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
 
 from app.api.schemas import (
     ConversionResponse, TaskStatusResponse, SupportedFormatsResponse,
-    StatusEnum, PendingTask, PendingTasksResponse, HealthResponse
+    StatusEnum, PendingTasksResponse, HealthResponse
 )
 from app.api.database import task_db
+from app.config.s3_config import get_s3_client, is_s3_enabled
 from app.config.settings import (
-    SUPPORTED_FORMATS, MARKER_FORMATS, PDF_BRIDGE_FORMATS,
-    MAX_FILE_SIZE, UPLOAD_DIR, RESULTS_DIR
+    SUPPORTED_FORMATS,
+    MAX_FILE_SIZE, UPLOAD_DIR, UPLOAD_INCOMING_DIR, RESULTS_DIR, RESULTS_ACCEL_REDIRECT_PREFIX
 )
 from app.utils.file_utils import (
-    create_result_zip, cleanup_task_files, get_file_extension, is_format_supported,
-    sanitize_filename  # Для безопасной обработки имен файлов
+    cleanup_task_files, get_file_extension,
+    sanitize_filename,  # Для безопасной обработки имен файлов
+    find_zip_documents, extract_zip_member
 )
+from app.utils.upload_stream import MultipartFileStream
 
 logger = logging.getLogger(__name__)
 
@@ -48,135 +49,277 @@ router = APIRouter()
 # Функция process_conversion удалена - обработка теперь в QueueWorker
 
 
-async def calculate_file_hash(file_content: bytes) -> str:
-    """Вычислить SHA256 hash файла."""
-    return hashlib.sha256(file_content).hexdigest()
+# Загрузка пишется и хешируется блоками по 1 MiB, а не каждым сетевым фрагментом
+UPLOAD_CHUNK_SIZE = 1 << 20
 
+# Запас на заголовки частей и прочие поля формы при проверке Content-Length multipart-запроса
+MULTIPART_OVERHEAD = 64 * 1024
 
-@router.post("/convert", response_model=ConversionResponse)
-async def convert_document(
-    file: UploadFile = File(...)
-):
+# Проверка расширения - поиск по множеству, а не по списку SUPPORTED_FORMATS
+_SUPPORTED_EXTS: frozenset = frozenset(SUPPORTED_FORMATS)
+# Документы, которые ищутся внутри ZIP (вложенные архивы не поддерживаются)
+_SUPPORTED_EXTS_NO_ZIP: frozenset = _SUPPORTED_EXTS - {'zip'}
+_NUM_FORMATS = len(SUPPORTED_FORMATS)
+
+# ZIP до этого размера принимается в память и на диск не пишется вовсе
+ZIP_SPOOL_MAX_SIZE = 16 << 20
+
+
+@lru_cache(maxsize=4096)
+def format_timestamp(timestamp: float) -> str:
+    """
+    Format a task timestamp for API responses (local time, str(datetime) format).
+    
+    created_at never changes, and clients poll the same tasks over and over,
+    so each value is formatted once instead of on every request.
+    """
+    return str(datetime.fromtimestamp(timestamp))
+
+
+# Сколько блоков может ждать хеширования, пока загрузка пишется дальше
+HASH_QUEUE_SIZE = 4
+
+
+async def write_and_hash_upload(upload, f) -> Tuple[int, str]:
+    """
+    Write the upload to f while a background task hashes the same blocks.
+    
+    The route only waits for the disk write before reading the next block;
+    hashing runs in a thread (hashlib releases the GIL) and overlaps both
+    the write and the network read.
+    
+    Returns:
+        Total upload size and SHA256 hex digest
+    """
+    hash_obj = hashlib.sha256()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=HASH_QUEUE_SIZE)
+    
+    async def hasher():
+        while (data := await queue.get()) is not None:
+            await asyncio.to_thread(hash_obj.update, data)
+    
+    async def write_block(data: bytes):
+        await f.write(data)
+        await queue.put(data)
+    
+    hasher_task = asyncio.create_task(hasher())
+    try:
+        total_size = await receive_upload(upload, write_block)
+        await queue.put(None)
+        await hasher_task
+    finally:
+        # При ошибке загрузки хешер больше не нужен
+        hasher_task.cancel()
+    return total_size, hash_obj.hexdigest()
+
+
+def stage_upload(staging_path: str, task_dir: str, filename: str) -> str:
+    """
+    Create the task directory and rename the staged upload into it.
+    
+    Both are filesystem metadata operations that can block on a busy disk,
+    so the route runs them together in a worker thread.
+    
+    Returns:
+        Final path of the document
+    """
+    # UPLOAD_DIR создается при старте, task_id свежий - хватает одного mkdir
+    os.mkdir(task_dir)
+    file_path = os.path.join(task_dir, filename)
+    os.replace(staging_path, file_path)
+    return file_path
+
+
+async def receive_upload(upload, write_block) -> int:
+    """
+    Read the upload body and hand it to write_block in UPLOAD_CHUNK_SIZE blocks.
+    
+    Returns:
+        Total upload size in bytes
+        
+    Raises:
+        HTTPException: 413 as soon as the body exceeds MAX_FILE_SIZE
+    """
+    total_size = 0
+    buffer = bytearray()
+    
+    async for chunk in upload:
+        total_size += len(chunk)
+        
+        # Проверяем размер на лету (частичный файл удалит вызывающий)
+        if total_size > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Max: {MAX_FILE_SIZE / 1024 / 1024} MB"
+            )
+        
+        # Копим сетевые фрагменты до UPLOAD_CHUNK_SIZE, затем пишем блок целиком
+        buffer += chunk
+        if len(buffer) >= UPLOAD_CHUNK_SIZE:
+            await write_block(bytes(buffer))
+            buffer.clear()
+    
+    if buffer:
+        await write_block(bytes(buffer))
+    return total_size
+
+
+# The body is read from request.stream() by the route itself, so the request
+# schema is declared here for the docs instead of via File(...)
+CONVERT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"]
+                }
+            },
+            "application/octet-stream": {
+                "schema": {"type": "string", "format": "binary"}
+            }
+        }
+    },
+    "parameters": [{
+        "name": "X-Filename",
+        "in": "header",
+        "required": False,
+        "description": "Filename for a raw (application/octet-stream) upload, URL-encoded",
+        "schema": {"type": "string"}
+    }]
+}
+
+
+@router.post("/convert", response_model=ConversionResponse, openapi_extra=CONVERT_REQUEST_BODY)
+async def convert_document(request: Request):
     """
     Upload a document for conversion to Markdown.
     
     Supported formats: doc, docx, odt, rtf, epub, html, htm, pptx, pdf, xls, xlsx
     
-    Parameters:
-    - file: Document file to convert
+    The document is sent either as the `file` field of a multipart/form-data
+    form, or as the raw request body with its name in the X-Filename header.
+    The body is hashed and written to disk as it arrives, without spooling it
+    to a temporary file first.
     """
+    staging_path = None
+    zip_spool = None
     try:
+        # Источник данных: поле file из multipart или тело запроса целиком
+        content_type, options = parse_options_header(request.headers.get('content-type', ''))
+        
+        # Заведомо слишком большой запрос отклоняем по Content-Length, не читая тело
+        # и не создавая папку; при chunked-передаче остается проверка на лету ниже
+        content_length = request.headers.get('content-length', '')
+        max_body_size = MAX_FILE_SIZE
+        if content_type == b'multipart/form-data':
+            max_body_size += MULTIPART_OVERHEAD
+        if content_length.isdigit() and int(content_length) > max_body_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large. Max: {MAX_FILE_SIZE / 1024 / 1024} MB"
+            )
+        if content_type == b'multipart/form-data':
+            if b'boundary' not in options:
+                raise HTTPException(status_code=400, detail="Missing multipart boundary")
+            upload = MultipartFileStream(request.stream(), options[b'boundary'])
+            filename = await upload.read_filename()
+        else:
+            upload = request.stream()
+            filename = unquote(request.headers.get('x-filename', ''))
+        
+        if not filename:
+            raise HTTPException(
+                status_code=400,
+                detail="No file uploaded: send a multipart 'file' field or an X-Filename header"
+            )
+        
         # ✅ Быстрая валидация ДО загрузки
-        if not is_format_supported(file.filename, SUPPORTED_FORMATS):
+        # Расширение разбирается один раз: и для проверки формата, и для ветки ZIP
+        ext = get_file_extension(filename)
+        if ext not in _SUPPORTED_EXTS:
             raise HTTPException(
                 status_code=400,
                 detail=f"Unsupported format. Supported: {', '.join(SUPPORTED_FORMATS)}"
             )
         
-        # ✅ Генерируем ID и создаем папку сразу
-        task_id = uuid.uuid4()
-        task_dir = os.path.join(UPLOAD_DIR, str(task_id))
-        os.makedirs(task_dir, exist_ok=True)
+        # ✅ Генерируем ID (сразу строкой - в таком виде он нужен везде ниже);
+        # папка задачи создается только после проверки кеша
+        task_id = str(uuid.uuid4())
+        task_dir = os.path.join(UPLOAD_DIR, task_id)
+        staging_path = os.path.join(UPLOAD_INCOMING_DIR, f"{task_id}.part")
         
-        safe_filename = sanitize_filename(file.filename)
-        file_path = os.path.join(task_dir, safe_filename)
+        is_zip = ext == 'zip'
+        
+        if is_zip:
+            # ZIP нужен только чтобы достать из него документ: держим его в памяти
+            # (большой сбрасывается во временный файл) и не хешируем - в БД хранится
+            # hash извлеченного документа, по hash архива кеш все равно не найдется
+            zip_spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE, dir=UPLOAD_INCOMING_DIR)
+            total_size = await receive_upload(
+                upload, lambda data: asyncio.to_thread(zip_spool.write, data)
+            )
+            logger.info(f"Uploaded ZIP {total_size / 1024 / 1024:.1f}MB")
+        else:
+            # ✅ НАСТОЯЩИЙ стриминг - сохраняем сразу на диск (во временный файл)
+            async with aiofiles.open(staging_path, 'wb') as f:
+                total_size, file_hash = await write_and_hash_upload(upload, f)
+            
+            logger.info(f"Uploaded {total_size / 1024 / 1024:.1f}MB, hash: {file_hash[:8]}...")
+            
+            # ✅ Проверяем кеш
+            cached_task = await task_db.get_task_by_hash(file_hash)
+            if cached_task and cached_task.get('result_path'):
+                if os.path.exists(cached_task['result_path']):
+                    logger.info(f"Cache hit for {file_hash[:8]}")
+                    # Загруженный файл - дубликат, его удалит finally
+                    return ConversionResponse(
+                        task_id=cached_task['id'],
+                        status=StatusEnum.COMPLETED,
+                        message='Using cached result'
+                    )
         
-        # ✅ НАСТОЯЩИЙ стриминг - сохраняем сразу на диск
-        total_size = 0
-        hash_obj = hashlib.sha256()
+        original_filename = filename
         
-        async with aiofiles.open(file_path, 'wb') as f:
-            while chunk := await file.read(8192):  # 8KB chunks
-                chunk_size = len(chunk)
-                total_size += chunk_size
+        # ✅ Обработка ZIP БЕЗ перезагрузки
+        if is_zip:
+            try:
+                # Чтение каталога архива и распаковка - блокирующий ввод-вывод, выполняем в потоке
+                docs = await asyncio.to_thread(find_zip_documents, zip_spool, _SUPPORTED_EXTS_NO_ZIP)
                 
-                # Проверяем размер на лету
-                if total_size > MAX_FILE_SIZE:
-                    await f.close()
-                    os.remove(file_path)  # Удаляем частично загруженный файл
-                    shutil.rmtree(task_dir, ignore_errors=True)
+                if len(docs) == 0:
                     raise HTTPException(
                         status_code=400,
-                        detail=f"File too large. Max: {MAX_FILE_SIZE / 1024 / 1024} MB"
+                        detail="ZIP архив пустой или не содержит поддерживаемых документов в корне"
+                    )
+                elif len(docs) > 1:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"В ZIP архиве найдено {len(docs)} документов. Поддерживается только ОДИН документ."
                     )
                 
-                # Считаем hash на лету
-                hash_obj.update(chunk)
-                
-                # Сохраняем chunk
-                await f.write(chunk)
-        
-        file_hash = hash_obj.hexdigest()
-        logger.info(f"Uploaded {total_size / 1024 / 1024:.1f}MB, hash: {file_hash[:8]}...")
-        
-        # ✅ Проверяем кеш
-        cached_task = await task_db.get_task_by_hash(file_hash)
-        if cached_task and cached_task.get('result_path'):
-            if os.path.exists(cached_task['result_path']):
-                logger.info(f"Cache hit for {file_hash[:8]}")
-                # Удаляем только что загруженный файл (он дубликат)
-                os.remove(file_path)
-                shutil.rmtree(task_dir, ignore_errors=True)
-                return ConversionResponse(
-                    task_id=uuid.UUID(cached_task['id']),
-                    status=StatusEnum.COMPLETED,
-                    message='Using cached result'
+                # Извлекаем документ потоком блоками по 1 MiB во временный файл, как и
+                # обычную загрузку; hash считается за тот же проход, сам ZIP закроет finally
+                original_filename = os.path.basename(docs[0])
+                file_hash = await asyncio.to_thread(
+                    extract_zip_member, zip_spool, docs[0], staging_path, max_size=MAX_FILE_SIZE
                 )
-        
-        original_filename = file.filename
-        
-        # ✅ Обработка ZIP БЕЗ перезагрузки
-        if get_file_extension(file.filename) == 'zip':
-            try:
-                with zipfile.ZipFile(file_path, 'r') as zf:
-                    # Ищем документы
-                    docs = [n for n in zf.namelist() 
-                           if get_file_extension(n) in [fmt for fmt in SUPPORTED_FORMATS if fmt != 'zip']
-                           and not n.startswith('__MACOSX/')
-                           and '/' not in n]  # только в корне архива
-                    
-                    if len(docs) == 0:
-                        raise HTTPException(
-                            status_code=400,
-                            detail="ZIP архив пустой или не содержит поддерживаемых документов в корне"
-                        )
-                    elif len(docs) > 1:
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"В ZIP архиве найдено {len(docs)} документов. Поддерживается только ОДИН документ."
+                
+                # Проверяем кеш для извлеченного документа (дубликат удалит finally)
+                cached_task = await task_db.get_task_by_hash(file_hash)
+                if cached_task and cached_task.get('result_path'):
+                    if os.path.exists(cached_task['result_path']):
+                        logger.info(f"Cache hit for extracted doc {file_hash[:8]}")
+                        return ConversionResponse(
+                            task_id=cached_task['id'],
+                            status=StatusEnum.COMPLETED,
+                            message='Using cached result'
                         )
-                    
-                    # Извлекаем документ
-                    doc_content = zf.read(docs[0])
-                    original_filename = os.path.basename(docs[0])
-                    
-                    # Пересчитываем hash для извлеченного документа
-                    file_hash = hashlib.sha256(doc_content).hexdigest()
-                    
-                    # Проверяем кеш для извлеченного документа
-                    cached_task = await task_db.get_task_by_hash(file_hash)
-                    if cached_task and cached_task.get('result_path'):
-                        if os.path.exists(cached_task['result_path']):
-                            logger.info(f"Cache hit for extracted doc {file_hash[:8]}")
-                            os.remove(file_path)
-                            shutil.rmtree(task_dir, ignore_errors=True)
-                            return ConversionResponse(
-                                task_id=uuid.UUID(cached_task['id']),
-                                status=StatusEnum.COMPLETED,
-                                message='Using cached result'
-                            )
-                    
-                    # Сохраняем извлеченный документ
-                    new_file_path = os.path.join(task_dir, sanitize_filename(original_filename))
-                    async with aiofiles.open(new_file_path, 'wb') as f:
-                        await f.write(doc_content)
-                    
-                    # Удаляем ZIP, оставляем только документ
-                    os.remove(file_path)
-                    file_path = new_file_path
-                    
-                    logger.info(f"Extracted from ZIP: {original_filename}")
-                    
+                
+                logger.info(f"Extracted from ZIP: {original_filename}")
+                
             except zipfile.BadZipFile:
                 raise HTTPException(
                     status_code=400,
@@ -190,9 +333,16 @@ async def convert_document(
                     detail=f"Ошибка обработки ZIP: {str(e)}"
                 )
         
+        # Переносим документ в папку задачи одним rename (та же файловая система);
+        # папка создается только здесь, так что при кеш-хите и ошибках ее нет вовсе
+        await asyncio.to_thread(
+            stage_upload, staging_path, task_dir, sanitize_filename(original_filename)
+        )
+        staging_path = None
+        
         # ✅ Создаем задачу
         await task_db.create_task(
-            str(task_id),
+            task_id,
             {
                 'original_filename': original_filename,
                 'status': StatusEnum.QUEUED,
@@ -202,7 +352,11 @@ async def convert_document(
             }
         )
         
-        # Конвертация будет выполнена QueueWorker автоматически
+        # Конвертация будет выполнена QueueWorker автоматически,
+        # будим свободный воркер сразу, не дожидаясь следующего опроса БД
+        worker_pool = getattr(request.app.state, 'worker_pool', None)
+        if worker_pool:
+            worker_pool.notify(task_id)
         
         return ConversionResponse(
             task_id=task_id,
@@ -212,12 +366,24 @@ async def convert_document(
         
     except HTTPException:
         raise
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(
             status_code=500, 
             detail=f"Internal server error: {str(e)}"
         )
+    finally:
+        # Временный файл остается только если загрузка не дошла до папки задачи
+        # (ошибка, превышение размера или кеш-хит); после переноса staging_path = None
+        if staging_path:
+            try:
+                os.remove(staging_path)
+            except FileNotFoundError:
+                pass
+        if zip_spool is not None:
+            zip_spool.close()
 
 
 @router.get("/task/{task_id}", response_model=TaskStatusResponse)
@@ -230,23 +396,26 @@ async def get_task_status(task_id: uuid.UUID):
             detail=f"Task {task_id} not found"
         )
     
-    # Check if S3 is enabled
-    from app.config.s3_config import is_s3_enabled
-    
-    response = TaskStatusResponse(
-        task_id=task_id,
-        status=task['status'],
-        progress=task.get('progress', 0),
-        message=task['message'],
-        created_at=str(datetime.fromtimestamp(task['created_at'])),
-        s3_enabled=is_s3_enabled()
-    )
-    
-    # Add download URL if completed
-    if task['status'] == StatusEnum.COMPLETED:
-        response.result_url = f"/api/v1/download/{task_id}"
+    # Клиенты опрашивают этот эндпоинт каждые 1-2 секунды: словарь из своей БД
+    # сериализуется orjson напрямую, без валидации через TaskStatusResponse
+    return ORJSONResponse({
+        "task_id": task['id'],
+        "status": task['status'],
+        "progress": task.get('progress', 0),
+        "message": task['message'],
+        # Add download URL if completed
+        "result_url": f"/api/v1/download/{task['id']}" if task['status'] == StatusEnum.COMPLETED else None,
+        "created_at": format_timestamp(task['created_at']),
+        "s3_enabled": is_s3_enabled(),
+        "s3_images_count": None
+    })
+
+
+class ResultFileResponse(FileResponse):
+    """FileResponse that reads the result ZIP in 1 MiB blocks instead of 64 KiB."""
     
-    return response
+    # Каждый блок - отдельный переход в поток anyio и отдельный send в сокет
+    chunk_size = 1 << 20
 
 
 async def cleanup_after_download(task_id: str):
@@ -255,15 +424,13 @@ async def cleanup_after_download(task_id: str):
         # Wait a bit to ensure download completed
         await asyncio.sleep(2)
         
-        # Mark as downloaded
-        await task_db.update_task(task_id, {"downloaded": True})
-        
-        # Cleanup files
-        cleanup_task_files(task_id, UPLOAD_DIR, RESULTS_DIR)
-        
-        # Delete task from database
+        # Delete task from database. Отметка downloaded перед удалением не нужна:
+        # строка исчезает из /tasks/pending одним DELETE
         await task_db.delete_task(task_id)
         
+        # Cleanup files (блокирующие удаления - в потоке, не в event loop)
+        await asyncio.to_thread(cleanup_task_files, task_id, UPLOAD_DIR, RESULTS_DIR)
+        
         logger.info(f"Cleaned up files and database record for task {task_id}")
         
     except Exception as e:
@@ -293,24 +460,42 @@ async def download_result(task_id: uuid.UUID, background_tasks: BackgroundTasks)
         # Если есть S3 URL, возвращаем его как plain text
         logger.info(f"Returning S3 URL for task {task_id}: {s3_url}")
         # Schedule cleanup
-        background_tasks.add_task(cleanup_after_download, str(task_id))
+        background_tasks.add_task(cleanup_after_download, task['id'])
         return JSONResponse(content={"s3_url": s3_url}, status_code=200)
     
     # Иначе возвращаем локальный файл
+    # Один stat на запрос: его результат получает FileResponse и не повторяет stat сам
     result_path = task.get('result_path')
-    if not result_path or not os.path.exists(result_path):
+    try:
+        stat_result = os.stat(result_path) if result_path else None
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None:
         raise HTTPException(
             status_code=404, 
             detail="Result file not found"
         )
     
     # Schedule cleanup
-    background_tasks.add_task(cleanup_after_download, str(task_id))
+    background_tasks.add_task(cleanup_after_download, task['id'])
+    
+    filename = os.path.basename(result_path)
+    relative_path = os.path.relpath(result_path, RESULTS_DIR)
+    if RESULTS_ACCEL_REDIRECT_PREFIX and not relative_path.startswith('..'):
+        # Файл отдает nginx через sendfile(2), приложение только возвращает заголовок
+        return Response(
+            media_type="application/zip",
+            headers={
+                "X-Accel-Redirect": f"{RESULTS_ACCEL_REDIRECT_PREFIX}/{quote(relative_path)}",
+                "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+            }
+        )
     
-    return FileResponse(
+    return ResultFileResponse(
         result_path,
-        filename=os.path.basename(result_path),
-        media_type="application/zip"
+        filename=filename,
+        media_type="application/zip",
+        stat_result=stat_result
     )
 
 
@@ -323,26 +508,39 @@ async def get_supported_formats():
 
 
 @router.get("/tasks/pending", response_model=PendingTasksResponse)
-async def get_pending_tasks():
-    """Get all pending (not downloaded) tasks."""
+async def get_pending_tasks(
+    limit: int = Query(100, ge=1, le=1000),
+    before: Optional[float] = Query(None, description="Return tasks created before this timestamp (next_before of the previous page)"),
+    before_id: str = Query("", description="Task id tie-breaker for tasks created at `before` (next_before_id of the previous page)")
+):
+    """Get pending (not downloaded) tasks, newest first, one page at a time."""
     try:
-        db_tasks = await task_db.get_pending_tasks()
+        db_tasks, total = await task_db.get_pending_tasks_with_count(
+            limit=limit, before_created_at=before, before_id=before_id
+        )
         
-        tasks = []
-        for db_task in db_tasks:
-            tasks.append(PendingTask(
-                task_id=uuid.UUID(db_task['id']),
-                original_filename=db_task['original_filename'],
-                status=db_task['status'],
-                created_at=str(datetime.fromtimestamp(db_task['created_at'])),
-                progress=db_task.get('progress', 0),
-                downloaded=bool(db_task['downloaded'])
-            ))
+        # Строки из своей же БД: отдаем словари через orjson без валидации каждого поля
+        tasks = [
+            {
+                "task_id": db_task['id'],
+                "original_filename": db_task['original_filename'],
+                "status": db_task['status'],
+                "created_at": format_timestamp(db_task['created_at']),
+                "progress": db_task.get('progress', 0),
+                "downloaded": bool(db_task['downloaded'])
+            }
+            for db_task in db_tasks
+        ]
+        # Курсор следующей страницы - (created_at, id) последней задачи:
+        # у задач одной пачки created_at совпадает
+        has_more = len(tasks) == limit
         
-        return PendingTasksResponse(
-            tasks=tasks,
-            total=len(tasks)
-        )
+        return ORJSONResponse({
+            "tasks": tasks,
+            "total": total,
+            "next_before": db_tasks[-1]['created_at'] if has_more else None,
+            "next_before_id": db_tasks[-1]['id'] if has_more else None
+        })
         
     except Exception as e:
         logger.error(f"Error getting pending tasks: {e}")
@@ -369,6 +567,10 @@ async def get_queue_statistics():
         )
 
 
+# Сколько health check ждет ответа S3, прежде чем считать его недоступным (секунды)
+S3_HEALTH_TIMEOUT = 2.0
+
+
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
     """Check service health."""
@@ -378,47 +580,39 @@ async def health_check():
         "database": False,
         "s3_enabled": False,
         "s3_connected": None,
-        "supported_formats": len(SUPPORTED_FORMATS),
+        "supported_formats": _NUM_FORMATS,
         "pending_tasks": 0
     }
     
     try:
         # Проверка базы данных
-        pending_tasks = await task_db.get_pending_tasks()
+        pending_tasks = await task_db.count_pending_tasks()
         health_status["database"] = True
-        health_status["pending_tasks"] = len(pending_tasks)
+        health_status["pending_tasks"] = pending_tasks
     except Exception as e:
         logger.error(f"Database check failed: {e}")
         health_status["status"] = "degraded"
         
     # Проверка S3
-    from app.config.s3_config import is_s3_enabled
     health_status["s3_enabled"] = is_s3_enabled()
     
     if health_status["s3_enabled"]:
         try:
-            # Проверяем подключение к S3
-            import boto3
-            from botocore.config import Config
-            import os
-            
-            config = Config(signature_version='s3')
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-                endpoint_url=os.environ.get('AWS_S3_ENDPOINT_URL', '').strip('"'),
-                region_name=os.environ.get('AWS_S3_REGION_NAME', 'ru1'),
-                config=config,
-                verify=False
-            )
-            
+            # Проверяем подключение к S3; boto3 блокирующий, поэтому в потоке
             bucket_name = os.environ.get('AWS_STORAGE_BUCKET_NAME')
-            s3_client.head_bucket(Bucket=bucket_name)
+            s3_client = await asyncio.to_thread(get_s3_client)
+            # Медленный S3 не должен задерживать ответ health-пробы
+            await asyncio.wait_for(
+                asyncio.to_thread(s3_client.head_bucket, Bucket=bucket_name),
+                timeout=S3_HEALTH_TIMEOUT
+            )
             health_status["s3_connected"] = True
+        except asyncio.TimeoutError:
+            logger.warning(f"S3 connection check timed out after {S3_HEALTH_TIMEOUT}s")
+            health_status["s3_connected"] = False
         except Exception as e:
             logger.warning(f"S3 connection check failed: {e}")
             health_status["s3_connected"] = False
             # S3 необязателен, поэтому не меняем общий статус
     
-    return HealthResponse(**health_status)
\ No newline at end of file
+    return ORJSONResponse(health_status)
\ No newline at end of file
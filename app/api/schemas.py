@@ -54,6 +54,8 @@ class PendingTask(BaseModel):
 class PendingTasksResponse(BaseModel):
     tasks: List[PendingTask]
     total: int
+    next_before: Optional[float] = None
+    next_before_id: Optional[str] = None
 
 
 class HealthResponse(BaseModel):
@@ -3,6 +3,7 @@
 """
 
 import os
+from functools import lru_cache
 from typing import Optional, Dict, Any
 
 
@@ -35,11 +36,48 @@ def get_s3_config() -> Optional[Dict[str, Any]]:
     return config
 
 
+@lru_cache(maxsize=1)
 def is_s3_enabled() -> bool:
-    """Проверяет, включена ли S3 интеграция."""
+    """
+    Проверяет, включена ли S3 интеграция.
+    
+    Переменные окружения читаются один раз: S3 включается и отключается
+    только перезапуском сервиса.
+    """
     return get_s3_config() is not None
 
 
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """
+    Возвращает общий S3 клиент для проверки подключения (health check).
+    
+    Клиент создается один раз: сборка boto3 клиента разбирает конфигурацию и
+    заводит новый пул соединений, то есть на каждый запрос уходил бы еще и
+    новый TLS handshake. Клиенты boto3 потокобезопасны.
+    """
+    import boto3
+    from botocore.config import Config
+    
+    # Короткие таймауты без повторов: проверка, которую health check уже бросил
+    # по своему таймауту, не должна еще минуту занимать поток
+    config = Config(
+        signature_version='s3',
+        connect_timeout=2,
+        read_timeout=2,
+        retries={'total_max_attempts': 1}
+    )
+    return boto3.client(
+        's3',
+        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+        endpoint_url=os.environ.get('AWS_S3_ENDPOINT_URL', '').strip('"'),
+        region_name=os.environ.get('AWS_S3_REGION_NAME', 'ru1'),
+        config=config,
+        verify=False
+    )
+
+
 # Пример использования в README для S3
 S3_SETUP_EXAMPLE = """
 # Настройка S3 для хранения изображений
@@ -12,6 +12,8 @@ SERVICE_ROOT = Path(__file__).resolve().parent.parent
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "8000"))
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
+# Разрешенные CORS-источники через запятую; пустое значение отключает CORS middleware
+CORS_ALLOW_ORIGINS = [o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",") if o.strip()]
 
 # File settings
 MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "50"))
@@ -21,8 +23,17 @@ MAX_FILE_SIZE = MAX_FILE_SIZE_MB * 1024 * 1024
 UPLOAD_DIR = os.path.join(PROJECT_ROOT, "temp", "uploads")
 RESULTS_DIR = os.path.join(PROJECT_ROOT, "temp", "results")
 
+# Загрузки сначала пишутся сюда и переносятся в папку задачи одним rename,
+# только если по hash не нашелся готовый результат
+UPLOAD_INCOMING_DIR = os.path.join(UPLOAD_DIR, ".incoming")
+
+# Отдача результатов через nginx (X-Accel-Redirect): внутренний location, под которым
+# nginx раздает RESULTS_DIR, например "/internal-results". Пусто - файл отдает само приложение
+RESULTS_ACCEL_REDIRECT_PREFIX = os.getenv("RESULTS_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+
 # Ensure directories exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(UPLOAD_INCOMING_DIR, exist_ok=True)
 os.makedirs(RESULTS_DIR, exist_ok=True)
 
 # Единый список всех поддерживаемых форматов
@@ -46,9 +57,29 @@ DB_PATH = os.path.join(DATA_DIR, "tasks.db")
 # Cleanup settings
 CLEANUP_DAYS = int(os.getenv("CLEANUP_DAYS", "7"))
 
+# Queue worker settings
+NUM_WORKERS = int(os.getenv("NUM_WORKERS", "3"))  # Количество воркеров очереди
+# Адаптивный опрос: после задачи интервал сбрасывается до минимума,
+# после каждого пустого опроса растет в 1.5 раза до максимума
+POLL_INTERVAL_MIN = float(os.getenv("POLL_INTERVAL_MIN", "0.05"))  # Минимальный интервал опроса (секунды)
+POLL_INTERVAL_MAX = float(os.getenv("POLL_INTERVAL_MAX", "5.0"))  # Максимальный интервал опроса (секунды)
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.05"))  # Случайный разброс интервала опроса (±секунды)
+# Аренда задач: воркер продлевает claimed_at каждые LEASE_HEARTBEAT_INTERVAL секунд,
+# задача без продления дольше STALE_TIMEOUT возвращается в очередь
+LEASE_HEARTBEAT_INTERVAL = int(os.getenv("LEASE_HEARTBEAT_INTERVAL", "30"))  # Интервал продления аренды (секунды)
+STALE_TIMEOUT = int(os.getenv("STALE_TIMEOUT", "90"))  # Через сколько секунд без heartbeat задача считается зависшей
+STALE_CHECK_INTERVAL = int(os.getenv("STALE_CHECK_INTERVAL", "30"))  # Интервал проверки зависших задач
+
 # LibreOffice conversion timeouts (in seconds)
 LIBREOFFICE_TIMEOUT_DEFAULT = int(os.getenv("LIBREOFFICE_TIMEOUT_DEFAULT", "180"))  # 3 минуты для обычных файлов
 LIBREOFFICE_TIMEOUT_COMPLEX = int(os.getenv("LIBREOFFICE_TIMEOUT_COMPLEX", "300"))  # 5 минут для PDF и EPUB
+# Таймаут конвертации Marker (в секундах); по истечении задача помечается упавшей
+MARKER_TIMEOUT = int(os.getenv("MARKER_TIMEOUT", "300"))
+# Параллельные процессы LibreOffice. Каждый слот запускается со своим профилем
+# (-env:UserInstallation): с общим профилем второй экземпляр не стартует, а готовый
+# профиль не приходится заново создавать при каждом запуске
+LIBREOFFICE_MAX_PROCESSES = int(os.getenv("LIBREOFFICE_MAX_PROCESSES", "2"))
+LIBREOFFICE_PROFILE_DIR = os.path.join(PROJECT_ROOT, "temp", "libreoffice")
 
 # S3 Settings
 S3_ENABLED = os.getenv('AWS_ACCESS_KEY_ID') is not None
@@ -8,18 +8,18 @@ Marker обеспечивает высокое качество конверта
 - Заголовков и структуры документа
 """
 
+import asyncio
 import os
-import sys
-import tempfile
 import logging
-import subprocess
-import json
-import shutil
+import re
+import threading
 import warnings
-from pathlib import Path
-from typing import List, Tuple, Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Tuple, Optional, Dict
 
 # Storage service import moved to where it's used
+from app.config.settings import MARKER_TIMEOUT
 from .base import BaseConverter
 
 # Suppress NCX warnings from ebooklib that can cause issues in Docker
@@ -29,54 +29,131 @@ warnings.filterwarnings('ignore', category=UserWarning, module='ebooklib')
 logger = logging.getLogger(__name__)
 
 
+# Модели Marker (детекция, разметка, OCR) занимают гигабайты и грузятся секундами,
+# поэтому загружаются один раз на процесс и разделяются всеми экземплярами конвертера
+_model_dict: Optional[Dict] = None
+_model_dict_lock = threading.Lock()
+
+# Предикторы Marker/surya хранят состояние между вызовами и не рассчитаны на
+# параллельные вызовы из разных потоков, поэтому конвертации через общие модели
+# выполняются по одной (раньше каждую изолировал отдельный процесс marker_single).
+# Отдельный однопоточный пул: зависшая конвертация держит только свой поток,
+# а не потоки общего пула, которым пользуются asyncio.to_thread в роутах
+_marker_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="marker")
+
+# Пул для сохранения изображений; ограничен, чтобы документ со множеством
+# картинок не занимал все ядра, нужные параллельным конвертациям
+_image_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="marker-images")
+
+
+def _load_model_dict() -> Dict:
+    """
+    Загружает модели Marker из кеша моделей.
+    
+    В Docker-образе модели уже лежат в MODEL_CACHE_DIR (копируются при сборке),
+    а HF_HUB_OFFLINE запрещает обращения к HuggingFace Hub во время работы.
+    """
+    logger.info("Loading Marker models...")
+    # Убеждаемся, что используем CPU device
+    os.environ.setdefault('TORCH_DEVICE', 'cpu')
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    
+    from marker.models import create_model_dict
+    try:
+        model_dict = create_model_dict()
+    except Exception as e:
+        logger.error(f"Failed to load Marker models: {e}")
+        raise
+    logger.info("Marker models loaded successfully")
+    return model_dict
+
+
+def get_model_dict() -> Dict:
+    """
+    Возвращает общий для процесса набор моделей Marker, загружая его при первом вызове.
+    
+    Загрузка блокирующая и вызывается из рабочих потоков, поэтому защищена
+    threading.Lock: параллельные задачи не загружают модели дважды.
+    """
+    global _model_dict
+    if _model_dict is None:
+        with _model_dict_lock:
+            if _model_dict is None:
+                _model_dict = _load_model_dict()
+    return _model_dict
+
+
 class MarkerConverter(BaseConverter):
     """Конвертер на основе Marker для PDF файлов."""
     
-    def __init__(self):
-        """Инициализация конвертера."""
-        super().__init__()
-        self._model_dict: Optional[Dict] = None
-    
     @property
     def model_dict(self) -> Dict:
-        """Ленивая загрузка моделей Marker."""
-        if self._model_dict is None:
-            logger.info("Loading Marker models...")
-            try:
-                # Убеждаемся, что используем CPU device
-                import os
-                os.environ.setdefault('TORCH_DEVICE', 'cpu')
-                os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
-                
-                from marker.models import create_model_dict
-                self._model_dict = create_model_dict()
-                logger.info("Marker models loaded successfully")
-            except Exception as e:
-                logger.error(f"Failed to load Marker models: {e}")
-                # В Docker контейнере попробуем принудительно указать путь к моделям
-                if os.path.exists("/.dockerenv"):
-                    logger.warning("Running in Docker - attempting alternative model loading")
-                    try:
-                        # Попробуем загрузить модели из альтернативных путей
-                        model_paths = [
-                            "/root/.cache/huggingface/hub",
-                            "/root/.cache/marker/models",
-                            "/root/.cache/datalab/models"
-                        ]
-                        for path in model_paths:
-                            if os.path.exists(path):
-                                logger.info(f"Found model cache at: {path}")
-                                os.environ['HF_HOME'] = os.path.dirname(path)
-                                break
-                        # Повторная попытка загрузки
-                        self._model_dict = create_model_dict()
-                        logger.info("Marker models loaded successfully on retry")
-                    except Exception as retry_e:
-                        logger.error(f"Retry failed: {retry_e}")
-                        raise
-                else:
-                    raise
-        return self._model_dict
+        """Модели Marker, общие для всех экземпляров конвертера."""
+        return get_model_dict()
+    
+    def _convert_sync(self, input_path: str, output_dir: str,
+                      abandoned: threading.Event) -> Tuple[str, Optional[str]]:
+        """
+        Конвертирует документ вызовом Marker в текущем процессе.
+        
+        Модели уже загружены (get_model_dict), поэтому нет ни запуска
+        интерпретатора, ни повторной загрузки весов, как у marker_single.
+        abandoned выставляется по таймауту: поток прервать нельзя, но он
+        не начинает конвертацию и не пишет результат задачи, которая уже упала.
+        """
+        from marker.converters.pdf import PdfConverter
+        from marker.output import convert_if_not_rgb, text_from_rendered
+        from marker.settings import settings as marker_settings
+        
+        # Marker сам определяет формат файла (PDF, DOCX, PPTX, XLSX, EPUB)
+        if abandoned.is_set():
+            raise TimeoutError(f"Marker conversion abandoned: {input_path}")
+        converter = PdfConverter(artifact_dict=self.model_dict)
+        rendered = converter(input_path)
+        if abandoned.is_set():
+            raise TimeoutError(f"Marker conversion abandoned: {input_path}")
+        text, _, images = text_from_rendered(rendered)
+        
+        logger.info("Marker conversion completed successfully")
+        
+        # Создаем директорию для изображений в выходной папке
+        images_dir = os.path.join(output_dir, "images")
+        os.makedirs(images_dir, exist_ok=True)
+        
+        # Изображения приходят из Marker в памяти - сохраняем их сразу в выходную директорию.
+        # Кодирование в PIL отпускает GIL, поэтому изображения сохраняются параллельно
+        def save_image(item) -> str:
+            img_name, img = item
+            new_img_path = os.path.join(images_dir, img_name)
+            convert_if_not_rgb(img).save(new_img_path, marker_settings.OUTPUT_IMAGE_FORMAT)
+            return new_img_path
+        
+        final_image_paths = list(_image_executor.map(save_image, images.items()))
+        
+        # Обновляем пути в markdown за один проход: замена по каждому изображению
+        # копировала бы весь текст заново, O(изображений * длины текста)
+        if images:
+            # Длинные имена первыми, чтобы имя-префикс не перехватило совпадение
+            pattern = re.compile("|".join(
+                re.escape(name) for name in sorted(images, key=len, reverse=True)
+            ))
+            text = pattern.sub(lambda m: f"./images/{m.group(0)}", text)
+        
+        logger.info(f"Saved {len(final_image_paths)} images")
+        
+        # Сохраняем markdown
+        output_path = os.path.join(output_dir, "document.md")
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        
+        # Возвращаем путь к папке с изображениями или None
+        if final_image_paths:
+            images_dir_result = images_dir
+        else:
+            images_dir_result = None
+        
+        logger.info(f"Marker conversion completed: {len(text)} chars, {len(final_image_paths)} images")
+        return output_path, images_dir_result
     
     async def convert(self, input_path: str, output_dir: str, type_result: str = None) -> Tuple[str, Optional[str]]:
         """
@@ -92,172 +169,30 @@ class MarkerConverter(BaseConverter):
         """
         logger.info(f"Converting with Marker API: {input_path}")
         
+        abandoned = threading.Event()
         try:
-            # Используем marker_single CLI для всех форматов
-            # Marker автоматически определяет формат файла
-            
-            # Создаем временную директорию для вывода Marker
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Подготавливаем окружение с правильным PATH
-                # Это решает проблему с uvicorn reload=True, который теряет venv
-                env = os.environ.copy()
-                
-                # Проверяем, работаем ли мы в Docker
-                if not os.path.exists("/.dockerenv"):
-                    # Локальная разработка - добавляем bin директорию venv в PATH
-                    venv_bin = os.path.join(sys.prefix, "bin")
-                    if os.path.exists(venv_bin):
-                        env['PATH'] = f"{venv_bin}:{env.get('PATH', '')}"
-                        logger.debug(f"Added venv bin to PATH: {venv_bin}")
-                
-                # Используем обычное имя команды - она найдется через PATH
-                cmd = [
-                    "marker_single",
-                    input_path,
-                    "--output_dir", temp_dir,
-                    "--output_format", "markdown",  # Явно указываем формат вывода
-                ]
-                
-                logger.info(f"Running command: {' '.join(cmd)}")
-                logger.debug(f"Using PATH: {env.get('PATH', 'default')}")
-                
-                # Запускаем процесс конвертации с модифицированным окружением
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    env=env  # Передаем окружение с правильным PATH
-                )
-                
-                # Добавляем таймаут 300 секунд (5 минут) для предотвращения зависания
-                try:
-                    stdout, stderr = process.communicate(timeout=300)
-                except subprocess.TimeoutExpired:
-                    logger.error(f"Marker timeout after 300s for {input_path}")
-                    process.kill()
-                    # Ждем завершения процесса после kill
-                    try:
-                        stdout, stderr = process.communicate(timeout=5)
-                    except subprocess.TimeoutExpired:
-                        process.terminate()
-                        stdout, stderr = "", "Process terminated due to timeout"
-                    raise Exception(f"Marker conversion timeout after 300 seconds")
-                
-                # ВАЖНО: Проверяем только код возврата, а не наличие stderr
-                # Многие программы выводят предупреждения в stderr, но это не означает ошибку
-                if process.returncode != 0:
-                    # Только если код возврата не 0, считаем это ошибкой
-                    logger.error(f"Marker failed with code {process.returncode}: {stderr}")
-                    # Очищаем stderr от известных безопасных предупреждений для сообщения об ошибке
-                    stderr_lines = stderr.strip().split('\n') if stderr else []
-                    real_errors = []
-                    for line in stderr_lines:
-                        # Пропускаем известные предупреждения
-                        if 'UserWarning: In the future version we will turn default option ignore_ncx' in line:
-                            continue
-                        if 'ebooklib/epub.py' in line and 'UserWarning' in line:
-                            continue
-                        if 'FutureWarning: This search incorrectly ignores the root element' in line:
-                            continue
-                        if not line.strip():
-                            continue
-                        real_errors.append(line)
-                    
-                    error_msg = chr(10).join(real_errors) if real_errors else stderr
-                    raise Exception(f"Marker conversion failed: {error_msg}")
-                
-                # Логируем stderr только если это не просто предупреждения
-                if stderr:
-                    # Фильтруем известные безопасные предупреждения
-                    stderr_lines = stderr.strip().split('\n')
-                    real_errors = []
-                    for line in stderr_lines:
-                        # Пропускаем известные предупреждения от ebooklib
-                        if 'UserWarning: In the future version we will turn default option ignore_ncx' in line:
-                            continue
-                        if 'ebooklib/epub.py' in line and 'UserWarning' in line:
-                            continue
-                        if 'FutureWarning: This search incorrectly ignores the root element' in line:
-                            continue
-                        # Пропускаем пустые строки
-                        if not line.strip():
-                            continue
-                        real_errors.append(line)
-                    
-                    # Логируем только реальные ошибки
-                    if real_errors:
-                        logger.warning(f"Marker stderr (non-critical): {chr(10).join(real_errors)}")
-                
-                logger.info("Marker conversion completed successfully")
-                
-                
-                # Ищем результаты
-                base_name = Path(input_path).stem
-                md_path = os.path.join(temp_dir, f"{base_name}.md")
-                
-                if not os.path.exists(md_path):
-                    # Проверяем, создал ли Marker директорию с именем файла
-                    output_dir_path = os.path.join(temp_dir, base_name)
-                    if os.path.isdir(output_dir_path):
-                        # Ищем .md файл внутри директории
-                        md_path = os.path.join(output_dir_path, f"{base_name}.md")
-                        if not os.path.exists(md_path):
-                            # Пробуем найти любой .md файл в директории
-                            md_files = list(Path(output_dir_path).glob("*.md"))
-                            if md_files:
-                                md_path = str(md_files[0])
-                    
-                    # Если все еще не нашли, ищем рекурсивно
-                    if not os.path.exists(md_path):
-                        md_files = list(Path(temp_dir).rglob("*.md"))
-                        if md_files:
-                            md_path = str(md_files[0])
-                        else:
-                            raise Exception("Marker did not produce markdown output")
-                
-                # Читаем markdown содержимое
-                with open(md_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                
-                # Создаем директорию для изображений в выходной папке
-                images_dir = os.path.join(output_dir, "images")
-                os.makedirs(images_dir, exist_ok=True)
-                
-                # Ищем и копируем изображения
-                final_image_paths = []
-                # Marker может создавать изображения в поддиректории
-                image_patterns = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.bmp", 
-                                "*.PNG", "*.JPG", "*.JPEG", "*.GIF", "*.BMP"]
-                
-                for pattern in image_patterns:
-                    for img_file in Path(temp_dir).rglob(pattern):
-                        # Копируем изображение в выходную директорию
-                        img_name = img_file.name
-                        new_img_path = os.path.join(images_dir, img_name)
-                        shutil.copy2(str(img_file), new_img_path)
-                        final_image_paths.append(new_img_path)
-                        
-                        # Обновляем путь в markdown
-                        text = text.replace(str(img_file.relative_to(temp_dir)), f"./images/{img_name}")
-                        text = text.replace(img_name, f"./images/{img_name}")
-                
-                logger.info(f"Found and copied {len(final_image_paths)} images")
-            
-            # Сохраняем markdown
-            output_path = os.path.join(output_dir, "document.md")
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(text)
-            
-            # Возвращаем путь к папке с изображениями или None
-            if final_image_paths:
-                images_dir_result = images_dir
-            else:
-                images_dir_result = None
-            
-            logger.info(f"Marker conversion completed: {len(text)} chars, {len(final_image_paths)} images")
-            return output_path, images_dir_result
-            
+            # Конвертация и загрузка моделей блокирующие - выполняем в пуле Marker,
+            # чтобы event loop продолжал обслуживать запросы. Таймаут покрывает и
+            # ожидание в очереди пула. Таймаут обязателен:
+            # без него зависшая конвертация держала бы воркер вечно, а heartbeat
+            # продлевал бы аренду, и release_stale_tasks задачу бы не вернул
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(
+                    _marker_executor, self._convert_sync, input_path, output_dir, abandoned
+                ),
+                timeout=MARKER_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            abandoned.set()
+            logger.error(f"Marker timeout after {MARKER_TIMEOUT}s for {input_path}")
+            raise RuntimeError(f"Marker conversion timeout after {MARKER_TIMEOUT} seconds")
         except Exception as e:
             logger.error(f"Error during Marker conversion: {e}")
-            raise
\ No newline at end of file
+            raise
+
+
+@lru_cache(maxsize=1)
+def get_marker_converter() -> MarkerConverter:
+    """Общий экземпляр MarkerConverter для конвертеров, которые делегируют ему PDF."""
+    return MarkerConverter()
@@ -4,20 +4,40 @@ PDF Bridge Converter - конвертирует документы через п
 """
 
 import os
-import subprocess
 import logging
 import tempfile
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import AsyncIterator, Optional, Tuple
 import asyncio
-from asyncio import Lock
+from contextlib import asynccontextmanager
 
-from app.config.settings import LIBREOFFICE_TIMEOUT_DEFAULT, LIBREOFFICE_TIMEOUT_COMPLEX
+from app.config.settings import (
+    LIBREOFFICE_TIMEOUT_DEFAULT, LIBREOFFICE_TIMEOUT_COMPLEX,
+    LIBREOFFICE_MAX_PROCESSES, LIBREOFFICE_PROFILE_DIR
+)
 
 logger = logging.getLogger(__name__)
 
-# Глобальная блокировка для LibreOffice
-_libreoffice_lock = Lock()
+# Свободные слоты LibreOffice: у каждого слота свой профиль, поэтому процессы
+# разных слотов работают параллельно, а внутри слота - по одному
+_libreoffice_slots: asyncio.Queue = asyncio.Queue()
+for _slot in range(LIBREOFFICE_MAX_PROCESSES):
+    _libreoffice_slots.put_nowait(_slot)
+
+
+@asynccontextmanager
+async def _libreoffice_slot() -> AsyncIterator[str]:
+    """
+    Занимает свободный слот LibreOffice.
+    
+    Yields:
+        URI профиля слота для -env:UserInstallation
+    """
+    slot = await _libreoffice_slots.get()
+    try:
+        yield Path(LIBREOFFICE_PROFILE_DIR, f"slot_{slot}").as_uri()
+    finally:
+        _libreoffice_slots.put_nowait(slot)
 
 
 class PdfBridgeConverter:
@@ -32,10 +52,10 @@ class PdfBridgeConverter:
     def __init__(self):
         """Инициализация конвертера."""
         self.name = "PdfBridgeConverter"
-        # Импортируем MarkerConverter для обработки PDF
+        # Импортируем MarkerConverter для обработки PDF; экземпляр общий для процесса
         try:
-            from app.converters.marker_converter import MarkerConverter
-            self.marker_converter = MarkerConverter()
+            from app.converters.marker_converter import get_marker_converter
+            self.marker_converter = get_marker_converter()
             self.marker_available = True
         except ImportError:
             self.marker_available = False
@@ -65,14 +85,15 @@ class PdfBridgeConverter:
         input_file = Path(input_path)
         output_file = Path(output_dir) / f"{input_file.stem}_temp.pdf"
         
-        logger.info(f"Acquiring LibreOffice lock for {input_file.name}...")
-        async with _libreoffice_lock:
-            logger.info(f"Lock acquired, starting LibreOffice conversion for {input_file.name}")
+        logger.info(f"Acquiring LibreOffice slot for {input_file.name}...")
+        async with _libreoffice_slot() as profile_uri:
+            logger.info(f"Slot acquired, starting LibreOffice conversion for {input_file.name}")
             
             try:
                 # Команда для конвертации с помощью LibreOffice
                 cmd = [
-                    'libreoffice', '--headless', '--convert-to', 'pdf',
+                    'libreoffice', f'-env:UserInstallation={profile_uri}',
+                    '--headless', '--convert-to', 'pdf',
                     '--outdir', output_dir, str(input_file)
                 ]
                 
@@ -89,13 +110,14 @@ class PdfBridgeConverter:
                 # Запускаем процесс конвертации асинхронно
                 process = await asyncio.create_subprocess_exec(
                     *cmd,
-                    stdout=asyncio.subprocess.PIPE,
+                    # stdout LibreOffice не используется - не буферизуем его в памяти
+                    stdout=asyncio.subprocess.DEVNULL,
                     stderr=asyncio.subprocess.PIPE
                 )
                 
                 # Ждем завершения с выбранным таймаутом
                 try:
-                    stdout, stderr = await asyncio.wait_for(
+                    _, stderr = await asyncio.wait_for(
                         process.communicate(), 
                         timeout=timeout_seconds
                     )
@@ -1,16 +1,19 @@
 """
 Queue Worker - Фоновый обработчик задач из очереди SQLite.
-Реализует Pure SQLite Queue архитектуру без in-memory компонентов.
+Реализует Pure SQLite Queue архитектуру: очередь и аренда задач хранятся в SQLite,
+в памяти только передача уже захваченных задач от диспетчера пула воркерам.
 """
 
 import asyncio
 import logging
 import os
 import hashlib
+import random
+import socket
+import uuid
 from pathlib import Path
 from typing import Optional, Dict, Any
 from datetime import datetime
-import traceback
 from concurrent.futures import ThreadPoolExecutor
 
 from app.api.database import TaskDatabase
@@ -25,8 +28,7 @@ from app.config.settings import (
 )
 
 # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ #1: Импортируем РЕАЛЬНЫЕ функции
-from app.utils.file_utils import create_result_zip  # Реальная функция создания ZIP
-from app.services.s3_uploader import upload_result_to_s3  # Реальная функция загрузки в S3
+from app.utils.file_utils import create_result_zip, sanitize_filename  # Реальная функция создания ZIP
 
 logger = logging.getLogger(__name__)
 
@@ -34,25 +36,6 @@ logger = logging.getLogger(__name__)
 executor = ThreadPoolExecutor(max_workers=4)
 
 
-def secure_filename(filename: str) -> str:
-    """
-    Защищает имя файла от path traversal атак.
-    
-    Args:
-        filename: Исходное имя файла
-        
-    Returns:
-        Безопасное имя файла
-    """
-    # Берем только имя файла без пути
-    filename = os.path.basename(filename)
-    # Удаляем опасные символы
-    filename = filename.replace("..", "")
-    filename = filename.replace("/", "_")
-    filename = filename.replace("\\", "_")
-    return filename
-
-
 def calculate_file_hash(file_path: str) -> str:
     """
     Вычисляет SHA256 хэш файла для кеширования.
@@ -65,7 +48,7 @@ def calculate_file_hash(file_path: str) -> str:
     """
     hash_sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(1 << 20), b""):
             hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
 
@@ -111,6 +94,10 @@ async def async_upload_result_to_s3(
     Returns:
         URL загруженного файла или None
     """
+    # Загрузчик импортируется только при включенном S3: вызов стоит под
+    # проверкой S3_ENABLED, и без S3 модуль (и dotenv/boto3 за ним) не загружается
+    from app.services.s3_uploader import upload_result_to_s3
+    
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(
         executor,
@@ -151,10 +138,14 @@ class ConverterFactory:
         '.pptx': PdfBridgeConverter,
     }
     
+    # Экземпляры конвертеров по классу: конвертеры не хранят состояние между
+    # вызовами, поэтому один экземпляр обслуживает все задачи своего формата
+    _instances: Dict[type, BaseConverter] = {}
+    
     @classmethod
     def get_converter(cls, file_extension: str) -> BaseConverter:
         """
-        Возвращает экземпляр конвертера для данного расширения.
+        Возвращает общий экземпляр конвертера для данного расширения.
         
         Args:
             file_extension: Расширение файла (с точкой)
@@ -168,8 +159,12 @@ class ConverterFactory:
         converter_class = cls.CONVERTERS.get(file_extension.lower())
         if not converter_class:
             raise ValueError(f"Неподдерживаемый формат: {file_extension}")
-        # Конвертеры не принимают s3_config - создаем без параметров
-        return converter_class()
+        
+        converter = cls._instances.get(converter_class)
+        if converter is None:
+            # Конвертеры не принимают s3_config - создаем без параметров
+            converter = cls._instances[converter_class] = converter_class()
+        return converter
 
 
 class QueueWorker:
@@ -178,26 +173,29 @@ class QueueWorker:
     def __init__(self, 
                  worker_id: str,
                  db_manager: TaskDatabase,
-                 poll_interval: float = 1.0,
-                 stale_timeout: int = 300,
-                 libreoffice_semaphore: Optional[asyncio.Semaphore] = None):
+                 task_queue: asyncio.Queue,
+                 free_slots: asyncio.Semaphore,
+                 heartbeat_interval: int = 30,
+                 stale_timeout: int = 90):
         """
         Инициализация воркера.
         
         Args:
             worker_id: Уникальный ID воркера
             db_manager: Менеджер базы данных
-            poll_interval: Интервал опроса очереди в секундах
+            task_queue: Задачи, захваченные диспетчером пула
+            free_slots: Семафор свободных воркеров, по нему диспетчер решает, сколько задач захватить
+            heartbeat_interval: Интервал продления аренды текущей задачи (секунды)
             stale_timeout: Таймаут для освобождения зависших задач (секунды)
-            libreoffice_semaphore: Семафор для ограничения LibreOffice процессов
         """
         self.worker_id = worker_id
         self.db = db_manager
-        self.poll_interval = poll_interval
+        self.task_queue = task_queue
+        self.free_slots = free_slots
+        self.heartbeat_interval = heartbeat_interval
         self.stale_timeout = stale_timeout
         self.running = False
         self.current_task_id: Optional[str] = None
-        self.libreoffice_semaphore = libreoffice_semaphore
         
         # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ #4: Убираем локальный кеш - используем БД
         # self.file_cache удален - будем использовать get_task_by_hash из БД
@@ -205,44 +203,43 @@ class QueueWorker:
     async def start(self):
         """Запускает воркер."""
         self.running = True
-        logger.info(f"Воркер {self.worker_id} запущен")
+        logger.info("Воркер %s запущен", self.worker_id)
         
         try:
             while self.running:
+                # Задачу уже захватил в БД диспетчер пула
+                task = await self.task_queue.get()
+                self.current_task_id = task['id']
+                # Аренда записана на владельца захвата, его же id нужен для продления
+                heartbeat = asyncio.create_task(self._heartbeat(task['id'], task['worker_id']))
                 try:
-                    # Получаем следующую задачу из очереди
-                    task = await self.db.get_next_queued_task(self.worker_id)
-                    
-                    if task:
-                        self.current_task_id = task['id']
-                        await self._process_task(task)
-                        self.current_task_id = None
-                    else:
-                        # Нет задач - ждем
-                        await asyncio.sleep(self.poll_interval)
-                        
+                    await self._process_task(task)
                 except Exception as e:
-                    logger.error(f"Ошибка в цикле воркера {self.worker_id}: {e}")
-                    await asyncio.sleep(self.poll_interval)
+                    logger.error("Ошибка в цикле воркера %s: %s", self.worker_id, e)
+                finally:
+                    heartbeat.cancel()
+                    self.current_task_id = None
+                    self.free_slots.release()
                     
         except asyncio.CancelledError:
-            logger.info(f"Воркер {self.worker_id} остановлен")
+            logger.info("Воркер %s остановлен", self.worker_id)
             raise
     
-    async def stop(self):
-        """Останавливает воркер."""
-        self.running = False
+    async def _heartbeat(self, task_id: str, owner_id: str):
+        """
+        Продлевает аренду задачи, пока воркер ее обрабатывает.
         
-        # Освобождаем текущую задачу, если есть
-        if self.current_task_id:
-            await self.db.update_task(
-                self.current_task_id,
-                {
-                    'status': 'queued',
-                    'worker_id': None,
-                    'processing_started': None
-                }
-            )
+        Если воркер упадет, продления прекратятся и задача вернется
+        в очередь после stale_timeout без перезапуска сервиса.
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                if not await self.db.renew_task_lease(task_id, owner_id):
+                    logger.warning("Воркер %s потерял аренду задачи %s", self.worker_id, task_id)
+                    return
+            except Exception as e:
+                logger.error("Ошибка продления аренды задачи %s: %s", task_id, e)
     
     async def _process_task(self, task: Dict[str, Any]):
         """
@@ -252,7 +249,7 @@ class QueueWorker:
             task: Данные задачи из БД
         """
         task_id = task['id']
-        logger.info(f"Воркер {self.worker_id} начал обработку задачи {task_id}")
+        logger.info("Воркер %s начал обработку задачи %s", self.worker_id, task_id)
         
         try:
             # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ #4: Используем БД для проверки кеша
@@ -261,7 +258,7 @@ class QueueWorker:
                 cached_task = await self.db.get_task_by_hash(file_hash)
                 if cached_task and cached_task.get('result_path'):
                     if os.path.exists(cached_task['result_path']):
-                        logger.info(f"Используем кешированный результат для {task_id}")
+                        logger.info("Используем кешированный результат для %s", task_id)
                         
                         await self.db.update_task(
                             task_id,
@@ -280,44 +277,49 @@ class QueueWorker:
             result_dir = os.path.join(RESULTS_DIR, task_id)
             
             # Находим загруженный файл
+            # Имя на диске строит тот же sanitize_filename, что и роут при загрузке
             original_filename = task.get('original_filename', '')
-            safe_filename = secure_filename(original_filename)
+            original_path = Path(original_filename)
+            safe_filename = sanitize_filename(original_filename)
             input_file = os.path.join(upload_path, safe_filename)
             
             if not os.path.exists(input_file):
                 raise FileNotFoundError(f"Файл не найден: {input_file}")
             
+            # Прогресс и (если его не было) hash файла пишутся одним UPDATE
+            progress_update = {'progress': 30, 'message': 'Начата конвертация'}
+            
             # Вычисляем хэш, если его нет
             if not file_hash:
                 file_hash = await async_calculate_file_hash(input_file)
-                await self.db.update_task(task_id, {'file_hash': file_hash})
+                progress_update['file_hash'] = file_hash
             
-            # Создаем директорию для результатов
-            os.makedirs(result_dir, exist_ok=True)
+            # Создаем директорию для результатов. RESULTS_DIR создается при старте,
+            # поэтому достаточно одного mkdir; после возврата задачи в очередь
+            # директория может остаться от прошлой попытки
+            try:
+                os.mkdir(result_dir)
+            except FileExistsError:
+                pass
             
             # Определяем тип конвертера
-            file_extension = Path(original_filename).suffix.lower()
+            file_extension = original_path.suffix.lower()
             converter = ConverterFactory.get_converter(file_extension)
             
             # Обновляем прогресс
-            await self.db.update_task(task_id, {'progress': 30, 'message': 'Начата конвертация'})
+            await self.db.update_task(task_id, progress_update)
             
-            # Выполняем конвертацию (с семафором для LibreOffice если нужно)
-            if isinstance(converter, PdfBridgeConverter) and self.libreoffice_semaphore:
-                logger.info(f"Воркер {self.worker_id}: захват LibreOffice семафора для задачи {task_id}")
-                async with self.libreoffice_semaphore:
-                    markdown_path, images_dir = await converter.convert(input_file, result_dir)
-                logger.info(f"Воркер {self.worker_id}: освобождение LibreOffice семафора для задачи {task_id}")
-            else:
-                markdown_path, images_dir = await converter.convert(input_file, result_dir)
+            # Выполняем конвертацию. Число процессов LibreOffice ограничивают слоты
+            # PdfBridgeConverter только на время шага LibreOffice, а не всей конвертации
+            markdown_path, images_dir = await converter.convert(input_file, result_dir)
             
-            # Обновляем прогресс
-            await self.db.update_task(task_id, {'progress': 70, 'message': 'Создание результата'})
+            # Отдельного обновления прогресса перед архивацией нет: сборка ZIP
+            # занимает доли секунды, а следующим UPDATE задача сразу становится completed
             
             # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ #3: Создаем ZIP с правильным путем
             # Имя ZIP файла должно быть основано на оригинальном имени
-            base_name = Path(original_filename).stem
-            extension = Path(original_filename).suffix.lstrip('.')  # Убираем точку из расширения
+            base_name = original_path.stem
+            extension = original_path.suffix.lstrip('.')  # Убираем точку из расширения
             if extension:
                 zip_filename = f"{base_name}_{extension}_result.zip"
             else:
@@ -335,12 +337,12 @@ class QueueWorker:
                     images_dir,
                     zip_path
                 )
-                logger.info(f"ZIP архив создан: {actual_zip_path}")
+                logger.info("ZIP архив создан: %s", actual_zip_path)
                 
                 # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ #1: Правильная S3 интеграция
                 if S3_ENABLED:
                     try:
-                        logger.info(f"Загружаем результат в S3 для задачи {task_id}")
+                        logger.info("Загружаем результат в S3 для задачи %s", task_id)
                         s3_url = await async_upload_result_to_s3(
                             actual_zip_path,
                             original_filename,
@@ -349,12 +351,12 @@ class QueueWorker:
                         )
                         
                         if s3_url:
-                            logger.info(f"Результат загружен в S3: {s3_url}")
+                            logger.info("Результат загружен в S3: %s", s3_url)
                         else:
-                            logger.warning(f"Не удалось загрузить в S3 для задачи {task_id}")
+                            logger.warning("Не удалось загрузить в S3 для задачи %s", task_id)
                             
                     except Exception as s3_error:
-                        logger.error(f"Ошибка S3 для задачи {task_id}: {s3_error}")
+                        logger.error("Ошибка S3 для задачи %s: %s", task_id, s3_error)
                         # S3 необязателен, продолжаем с локальным файлом
                 
                 # Обновляем задачу как выполненную
@@ -369,13 +371,12 @@ class QueueWorker:
                     }
                 )
                 
-                logger.info(f"Задача {task_id} успешно выполнена воркером {self.worker_id}")
+                logger.info("Задача %s успешно выполнена воркером %s", task_id, self.worker_id)
                 
             except Exception as processing_error:
                 # ZEN ИСПРАВЛЕНИЕ #3: Обработка ошибок создания ZIP и S3
                 error_msg = f"Ошибка создания результата: {str(processing_error)}"
-                logger.error(f"Ошибка в создании результата для задачи {task_id}: {error_msg}")
-                logger.error(traceback.format_exc())
+                logger.exception("Ошибка в создании результата для задачи %s: %s", task_id, error_msg)
                 
                 # Обновляем статус как неудачный
                 await self.db.update_task(
@@ -392,12 +393,11 @@ class QueueWorker:
                     try:
                         os.remove(actual_zip_path)
                     except Exception as cleanup_error:
-                        logger.error(f"Ошибка очистки файла {actual_zip_path}: {cleanup_error}")
+                        logger.error("Ошибка очистки файла %s: %s", actual_zip_path, cleanup_error)
             
         except Exception as e:
             error_msg = f"Ошибка обработки: {str(e)}"
-            logger.error(f"Ошибка в задаче {task_id}: {error_msg}")
-            logger.error(traceback.format_exc())
+            logger.exception("Ошибка в задаче %s: %s", task_id, error_msg)
             
             await self.db.update_task(
                 task_id,
@@ -415,30 +415,49 @@ class QueueWorkerPool:
     def __init__(self, 
                  db_manager: TaskDatabase,
                  num_workers: int = 3,
-                 poll_interval: float = 1.0,
-                 stale_timeout: int = 300,
-                 stale_check_interval: int = 60):
+                 min_poll_interval: float = 0.05,
+                 max_poll_interval: float = 5.0,
+                 poll_jitter: float = 0.05,
+                 heartbeat_interval: int = 30,
+                 stale_timeout: int = 90,
+                 stale_check_interval: int = 30,
+                 claim_batch: int = 8):
         """
         Инициализация пула воркеров.
         
         Args:
             db_manager: Менеджер базы данных
             num_workers: Количество воркеров
-            poll_interval: Интервал опроса очереди
-            stale_timeout: Таймаут для зависших задач
+            min_poll_interval: Минимальный интервал опроса очереди
+            max_poll_interval: Максимальный интервал опроса пустой очереди
+            poll_jitter: Случайный разброс интервала опроса
+            heartbeat_interval: Интервал продления аренды задач воркерами
+            stale_timeout: Таймаут аренды для зависших задач
             stale_check_interval: Интервал проверки зависших задач
+            claim_batch: Максимум задач, захватываемых одним запросом
         """
         self.db = db_manager
         self.num_workers = num_workers
-        self.poll_interval = poll_interval
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_jitter = poll_jitter
+        self.heartbeat_interval = heartbeat_interval
         self.stale_timeout = stale_timeout
         self.stale_check_interval = stale_check_interval
+        self.claim_batch = claim_batch
+        self._current_sleep = min_poll_interval  # Текущий интервал адаптивного опроса
+        # Владелец аренды задач, захваченных пулом. Только pid не годится: в контейнере
+        # приложение всегда PID 1, и реплики с общей БД продлевали бы чужую аренду
+        self.dispatcher_id = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
         
         self.workers = []
         self.worker_tasks = []
+        self.dispatch_task = None
         self.stale_task = None
         self.running = False
-        self.libreoffice_semaphore = asyncio.Semaphore(2)  # Лимит параллельных LibreOffice процессов
+        self.wakeup_queue: asyncio.Queue = asyncio.Queue()  # Уведомления о новых задачах в этом процессе
+        self.task_queue: asyncio.Queue = asyncio.Queue()  # Захваченные задачи, которые разбирают воркеры
+        self.free_slots = asyncio.Semaphore(num_workers)  # Воркеры без задачи
         
         # ZEN ИСПРАВЛЕНИЕ #2: Блокировка для предотвращения race conditions в кешировании
         self.processing_lock = asyncio.Lock()
@@ -453,27 +472,121 @@ class QueueWorkerPool:
             worker = QueueWorker(
                 worker_id=worker_id,
                 db_manager=self.db,
-                poll_interval=self.poll_interval,
-                stale_timeout=self.stale_timeout,
-                libreoffice_semaphore=self.libreoffice_semaphore
+                task_queue=self.task_queue,
+                free_slots=self.free_slots,
+                heartbeat_interval=self.heartbeat_interval,
+                stale_timeout=self.stale_timeout
             )
             self.workers.append(worker)
             
             task = asyncio.create_task(worker.start())
             self.worker_tasks.append(task)
         
+        # Диспетчер захватывает задачи для свободных воркеров
+        self.dispatch_task = asyncio.create_task(self._dispatch())
+        
         # Запускаем проверку зависших задач
         self.stale_task = asyncio.create_task(self._release_stale_tasks())
         
-        logger.info(f"Запущен пул из {self.num_workers} воркеров")
+        logger.info("Запущен пул из %s воркеров", self.num_workers)
+    
+    def notify(self, task_id: str):
+        """Будит диспетчер после постановки задачи в очередь."""
+        self.wakeup_queue.put_nowait(task_id)
+    
+    async def _dispatch(self):
+        """
+        Захватывает задачи для свободных воркеров и раздает их через task_queue.
+        
+        Один UPDATE ... RETURNING берет столько задач, сколько воркеров свободно
+        (не больше claim_batch), вместо отдельной транзакции захвата на каждый
+        воркер. Впрок задачи не захватываются: у каждой захваченной задачи сразу
+        есть воркер, который продлевает ее аренду, а остальная очередь доступна
+        другим процессам.
+        """
+        while self.running:
+            await self.free_slots.acquire()
+            free = 1
+            while free < self.claim_batch and not self.free_slots.locked():
+                await self.free_slots.acquire()
+                free += 1
+            
+            # Захват увидит все уже созданные задачи, накопленные уведомления не нужны
+            while not self.wakeup_queue.empty():
+                self.wakeup_queue.get_nowait()
+            
+            try:
+                tasks = await self.db.get_next_queued_tasks(self.dispatcher_id, free)
+            except Exception as e:
+                logger.error("Ошибка захвата задач из очереди: %s", e)
+                tasks = []
+            
+            for task in tasks:
+                self.task_queue.put_nowait(task)
+            for _ in range(free - len(tasks)):
+                self.free_slots.release()
+            
+            if tasks:
+                # Очередь не пуста - следующий опрос сразу с минимальным интервалом
+                self._current_sleep = self.min_poll_interval
+            if len(tasks) < free:
+                # Задач меньше, чем свободных воркеров - ждем уведомления или следующего опроса
+                await self._wait_for_work(self._next_poll_delay())
+    
+    async def _wait_for_work(self, timeout: float):
+        """
+        Ждет уведомления о новой задаче, но не дольше timeout.
+        
+        Уведомление только будит диспетчер раньше срока: задачу он все равно
+        захватывает из БД, так что опрос остается страховкой для задач,
+        созданных другими процессами или до перезапуска.
+        """
+        try:
+            await asyncio.wait_for(self.wakeup_queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def _next_poll_delay(self) -> float:
+        """
+        Возвращает паузу до следующего опроса и увеличивает ее для следующего раза.
+        
+        Пока очередь пуста, интервал растет в 1.5 раза до max_poll_interval;
+        случайный разброс не дает пулам разных процессов опрашивать БД синхронно.
+        """
+        delay = self._current_sleep
+        self._current_sleep = min(self._current_sleep * 1.5, self.max_poll_interval)
+        return max(0.0, delay + random.uniform(-self.poll_jitter, self.poll_jitter))
     
     async def stop(self):
         """Останавливает пул воркеров."""
         self.running = False
         
-        # Останавливаем воркеры
+        # Сначала диспетчер, чтобы он не захватил новые задачи во время остановки
+        if self.dispatch_task:
+            self.dispatch_task.cancel()
+            await asyncio.gather(self.dispatch_task, return_exceptions=True)
+        
+        # Останавливаем воркеры и возвращаем их текущие задачи в очередь
+        # одной транзакцией вместо отдельного UPDATE на каждый воркер
+        active_task_ids = []
         for worker in self.workers:
-            await worker.stop()
+            worker.running = False
+            if worker.current_task_id:
+                active_task_ids.append(worker.current_task_id)
+        
+        # Захваченные диспетчером задачи, которые воркеры еще не взяли
+        while not self.task_queue.empty():
+            active_task_ids.append(self.task_queue.get_nowait()['id'])
+        
+        await self.db.update_tasks_bulk(
+            active_task_ids,
+            {
+                'status': 'queued',
+                'worker_id': None,
+                'processing_started': None,
+                'claimed_at': None
+            }
+        )
         
         # Отменяем задачи
         for task in self.worker_tasks:
@@ -499,9 +612,9 @@ class QueueWorkerPool:
             try:
                 released = await self.db.release_stale_tasks(self.stale_timeout)
                 if released > 0:
-                    logger.info(f"Освобождено {released} зависших задач")
+                    logger.info("Освобождено %s зависших задач", released)
                     
             except Exception as e:
-                logger.error(f"Ошибка при освобождении зависших задач: {e}")
+                logger.error("Ошибка при освобождении зависших задач: %s", e)
             
             await asyncio.sleep(self.stale_check_interval)
\ No newline at end of file
@@ -8,23 +8,34 @@ import mimetypes
 import logging
 import zipfile
 import tempfile
+from functools import lru_cache
 from typing import Optional, Dict
 from dotenv import load_dotenv
 
-try:
-    import boto3
-    from botocore.config import Config
-    from botocore.exceptions import ClientError
-    HAS_BOTO3 = True
-except ImportError:
-    HAS_BOTO3 = False
-
 logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения
 load_dotenv()
 
 
+@lru_cache(maxsize=1)
+def _boto3():
+    """
+    Импортирует boto3 при первом обращении к S3.
+    
+    Импорт boto3 занимает сотни миллисекунд и мегабайты памяти, поэтому
+    без S3 он не выполняется вовсе, а с S3 - один раз.
+    
+    Returns:
+        Модуль boto3 или None, если он не установлен
+    """
+    try:
+        import boto3
+        return boto3
+    except ImportError:
+        return None
+
+
 def upload_to_s3(
     file_path: str,
     s3_key: str,
@@ -43,9 +54,12 @@ def upload_to_s3(
     Returns:
         URL загруженного файла или None при ошибке
     """
-    if not HAS_BOTO3:
+    boto3 = _boto3()
+    if boto3 is None:
         logger.error("boto3 не установлен")
         return None
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
         
     if not os.path.exists(file_path):
         logger.error(f"Файл не найден: {file_path}")
@@ -141,7 +155,8 @@ def check_s3_file_exists(s3_key: str, bucket_name: Optional[str] = None) -> bool
     Returns:
         True если файл существует
     """
-    if not HAS_BOTO3:
+    boto3 = _boto3()
+    if boto3 is None:
         return False
         
     bucket_name = bucket_name or os.environ.get('AWS_STORAGE_BUCKET_NAME')
@@ -263,7 +278,7 @@ def upload_result_to_s3(
     Returns:
         S3 URL загруженного файла или None при ошибке
     """
-    if not HAS_BOTO3:
+    if _boto3() is None:
         logger.error("boto3 не установлен")
         return None
         
@@ -1,18 +1,36 @@
 import os
-import string  # Для безопасной валидации имен файлов
+import hashlib
+import re
 import zipfile
 import shutil
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import AbstractSet, BinaryIO, Collection, Optional, Union
 
 logger = logging.getLogger(__name__)
 
 
+# Уже сжатые форматы: deflate на них тратит CPU и почти ничего не выигрывает
+_PRECOMPRESSED_EXTS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'webp'})
+
+# Буфер копирования файла в ZIP: ZipFile.write копирует блоками по 8 KiB
+ZIP_COPY_BUFFER_SIZE = 1 << 20
+
+
+def _zip_write(zipf: zipfile.ZipFile, file_path: str, arcname: str, compress_type: int) -> None:
+    """Add a file to the archive like ZipFile.write, but copying in 1 MiB blocks."""
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = compress_type
+    with open(file_path, 'rb') as src, zipf.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, ZIP_COPY_BUFFER_SIZE)
+
+
 def create_result_zip(markdown_path: str, images_dir: Optional[str], output_path: str) -> str:
     """
     Create a ZIP archive with markdown file and images directory.
     
+    Markdown is deflated; already-compressed images are stored as is.
+    
     Args:
         markdown_path: Path to markdown file
         images_dir: Path to images directory (optional)
@@ -23,7 +41,7 @@ def create_result_zip(markdown_path: str, images_dir: Optional[str], output_path
     """
     with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
         # Add markdown file
-        zipf.write(markdown_path, "document.md")
+        _zip_write(zipf, markdown_path, "document.md", zipfile.ZIP_DEFLATED)
         
         # Add images if present
         if images_dir and os.path.exists(images_dir):
@@ -31,7 +49,10 @@ def create_result_zip(markdown_path: str, images_dir: Optional[str], output_path
                 for file in files:
                     file_path = os.path.join(root, file)
                     arcname = os.path.relpath(file_path, os.path.dirname(images_dir))
-                    zipf.write(file_path, arcname)
+                    if get_file_extension(file) in _PRECOMPRESSED_EXTS:
+                        _zip_write(zipf, file_path, arcname, zipfile.ZIP_STORED)
+                    else:
+                        _zip_write(zipf, file_path, arcname, zipfile.ZIP_DEFLATED)
     
     logger.info(f"Created result ZIP: {output_path}")
     return output_path
@@ -82,16 +103,70 @@ def cleanup_task_files(task_id: str, upload_dir: str, results_dir: str):
         logger.error(f"Cleanup errors for task {task_id}: {'; '.join(errors)}")
 
 
+def find_zip_documents(zip_path: Union[str, BinaryIO], document_formats: AbstractSet[str]) -> list:
+    """
+    List supported documents in the root of a ZIP archive.
+    
+    Args:
+        zip_path: Path to ZIP archive or a seekable binary file object
+        document_formats: Extensions to look for, without 'zip' (nested ZIPs are ignored)
+        
+    Returns:
+        Member names of documents found in the archive root
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        return [n for n in zf.namelist()
+                if get_file_extension(n) in document_formats
+                and not n.startswith('__MACOSX/')
+                and '/' not in n]  # только в корне архива
+
+
+def extract_zip_member(zip_path: Union[str, BinaryIO], member: str, output_path: str,
+                       chunk_size: int = 1 << 20, max_size: Optional[int] = None) -> str:
+    """
+    Stream one archive member to disk, hashing it in the same pass.
+    
+    Args:
+        zip_path: Path to ZIP archive or a seekable binary file object
+        member: Member name inside the archive
+        output_path: Path for the extracted file
+        chunk_size: Read block size
+        max_size: Reject members whose uncompressed size exceeds this
+        
+    Returns:
+        SHA256 hex digest of the extracted file
+        
+    Raises:
+        ValueError: If the member is larger than max_size
+    """
+    hash_obj = hashlib.sha256()
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        # Размер проверяется по каталогу до распаковки; zipfile не отдаст больше
+        # заявленного file_size, так что маленький архив не раздуется на диске
+        info = zf.getinfo(member)
+        if max_size is not None and info.file_size > max_size:
+            raise ValueError(f"Document in ZIP is too large: {info.file_size} bytes, max {max_size}")
+        with zf.open(info) as src, open(output_path, 'wb') as dst:
+            while chunk := src.read(chunk_size):
+                hash_obj.update(chunk)
+                dst.write(chunk)
+    return hash_obj.hexdigest()
+
+
 def get_file_extension(filename: str) -> str:
     """Get file extension in lowercase without dot."""
     return Path(filename).suffix.lower().lstrip('.')
 
 
-def is_format_supported(filename: str, supported_formats: list) -> bool:
+def is_format_supported(filename: str, supported_formats: Collection[str]) -> bool:
     """Check if file format is supported."""
     ext = get_file_extension(filename)
     return ext in supported_formats
 
+# Недопустимые в имени файла символы; компилируется один раз при импорте
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitize filename to prevent path traversal attacks.
@@ -105,15 +180,12 @@ def sanitize_filename(filename: str) -> str:
     # Get just the filename, removing any path components
     filename = os.path.basename(filename)
     
-    # Remove potentially dangerous characters
-    # Allow only alphanumeric, dots, hyphens, underscores
-    safe_chars = set(string.ascii_letters + string.digits + '.-_')
-    
     # Keep the extension
     name, ext = os.path.splitext(filename)
     
-    # Clean the name part
-    clean_name = ''.join(c if c in safe_chars else '_' for c in name)
+    # Clean the name part: every character except ASCII letters, digits,
+    # dots, hyphens and underscores becomes '_'
+    clean_name = _UNSAFE_FILENAME_CHARS.sub('_', name)
     
     # Ensure name is not empty
     if not clean_name:
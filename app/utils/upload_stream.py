@@ -0,0 +1,120 @@
+from typing import AsyncIterator, Dict, List, Optional
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+
+class MultipartFileStream:
+    """
+    Stream one file field of a multipart/form-data body as it arrives.
+
+    The body is fed to python-multipart chunk by chunk straight from the
+    ASGI receive channel, so the upload is never spooled to a temporary
+    file before the route sees it (which is what UploadFile does).
+
+    Usage:
+        upload = MultipartFileStream(request.stream(), boundary)
+        filename = await upload.read_filename()
+        async for chunk in upload:
+            ...
+    """
+
+    def __init__(self, body: AsyncIterator[bytes], boundary: bytes, field_name: str = "file"):
+        """
+        Args:
+            body: Raw request body chunks (request.stream())
+            boundary: Multipart boundary from the Content-Type header
+            field_name: Name of the form field holding the file
+        """
+        self._body = body.__aiter__()
+        self._field_name = field_name.encode()
+        self.filename: Optional[str] = None
+
+        self._data: List[bytes] = []  # File bytes parsed from the current body chunk
+        self._in_file = False
+        self._file_done = False
+        self._body_done = False
+
+        self._header_field = b''
+        self._header_value = b''
+        self._headers: Dict[bytes, bytes] = {}
+
+        self._parser = MultipartParser(boundary, {
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        if self.filename is None and options.get(b'name') == self._field_name and b'filename' in options:
+            self.filename = options[b'filename'].decode('utf-8', errors='replace')
+            self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_done = True
+
+    async def _feed(self) -> bool:
+        """Parse the next body chunk. Returns False once the body is exhausted."""
+        if self._body_done:
+            return False
+        try:
+            chunk = await self._body.__anext__()
+        except StopAsyncIteration:
+            self._body_done = True
+            self._parser.finalize()
+            return False
+        self._parser.write(chunk)
+        return True
+
+    async def read_filename(self) -> Optional[str]:
+        """
+        Read the body up to the end of the file part headers.
+
+        Returns:
+            Client-supplied filename, or None if the body has no such field
+        """
+        while self.filename is None and await self._feed():
+            pass
+        return self.filename
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        """
+        Yield the file contents; stops at the end of the file part.
+
+        Raises:
+            MultipartParseError: If the body ends before the file part does
+        """
+        while True:
+            if self._data:
+                data = b''.join(self._data)
+                self._data.clear()
+                yield data
+            if self._file_done:
+                return
+            if not await self._feed() and not self._file_done:
+                raise MultipartParseError("Unexpected end of multipart body")